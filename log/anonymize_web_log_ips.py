@@ -1,24 +1,97 @@
 #!/usr/bin/env python
 """ Takes an apache web log and replaces ips with a number to allows for anonymized analysis.
     Optionally some ips can be striped also.
+
+    Lines are handled as bytes, only the leading ip is replaced and the remainder of each line is written out
+    untouched so the output is identical to the input apart from the ip field.
+
+    The log and output can be '-' for stdin/stdout, files ending in .gz, .bz2, .xz or .zst are transparently
+    decompressed/compressed. For .xz and .zst the xz and zstd commands are used.
+
+    With --follow the log is anonymized as it grows in the manner of tail -F, the file is reopened when it is
+    rotated and the ip numbering is kept across rotations. Inotify is used to wait for changes when available
+    otherwise the file is polled.
+
+    With --stats per ip number request counts, bytes served and status classes along with a histogram of status
+    codes are collected in the same pass and written to a CSV or JSON file.
+
+    Skipped networks are compiled into sorted integer intervals and the result for each distinct ip string
+    is cached so the majority of lines from repeat visitors never need to be parsed by netaddr.
+
+    By default numbering starts from 0 on each run. With --mapping-db the ip to number mapping is kept in a
+    sqlite database so the same ip gets the same number across runs, only a bounded number of ips are kept
+    in memory and new numbers are written to the database in batches. Several runs can share a mapping db,
+    a lock file next to it is held by a run from when it assigns a new number until the batch is written.
+
+    With --jobs the log is split on line boundaries into byte ranges which are processed in parallel.
+    This is done in two passes, the first collects the ips found in each range which are then merged in
+    file order so the numbering is identical to a serial run, the second rewrites each range.
 """
 import argparse
+from array import array
+from bisect import bisect_right
+import bz2
+from collections import OrderedDict
+import csv
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import gzip
+import io
+import json
+import multiprocessing
 import netaddr
+from netaddr.ip import IPV4_LINK_LOCAL, IPV4_PRIVATE, IPV6_LINK_LOCAL, IPV6_PRIVATE
+import os
+import select
+import shutil
+import signal
+import sqlite3
+from subprocess import Popen, PIPE
 import sys
+import tempfile
+import time
+
+BUFFER_SIZE = 1024 * 1024
+# Number of lines buffered before a writelines call
+WRITE_BATCH = 1024
+# Compressed files handled by piping through an external command
+COMPRESS_COMMANDS = {'.xz': ['xz'], '.zst': ['zstd', '-q']}
+COMPRESSED_EXTENSIONS = ('.gz', '.bz2') + tuple(COMPRESS_COMMANDS.keys())
+
+# The networks netaddr's is_private() considers private
+PRIVATE_NETWORKS = IPV4_PRIVATE + (IPV4_LINK_LOCAL, ) + IPV6_PRIVATE + (IPV6_LINK_LOCAL, )
+
+# Set in main and inherited by the pool workers when they are forked
+SETTINGS = {}
 
 
 def main():
     # Parse arguments, build skip_set and paths as needed
     parser = argparse.ArgumentParser()
-    parser.add_argument('log_path', help='The path to the log to be anonymized')
-    parser.add_argument('--output', '-o', help='Output file, defaults to input file'
-                                               'with .anonymized extension')
+    parser.add_argument('log_path', help='The path to the log to be anonymized, - for stdin')
+    parser.add_argument('--output', '-o', help='Output file or - for stdout, defaults to input file'
+                                               'with .anonymized extension or stdout when reading stdin')
     parser.add_argument('--skip', '-s', action='append', help='A cidr notation network for which any'
                                                        'for which any source traffic will be removed'
                                                        'from the final output. Can be specified multiple'
                                                        'times')
     parser.add_argument('--skip_private', action='store_true', default=False,
                         help='If specified remove any private source ips from the final file')
+    parser.add_argument('--mapping-db', help='A sqlite database used to store the ip numbering between runs,'
+                                             ' it will be created if needed')
+    parser.add_argument('--cache-size', type=int, default=100000,
+                        help='Number of distinct ips to keep cached skip results and mapping-db numbers for,'
+                             ' defaults to 100000')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Number of processes used to anonymize the log, defaults to 1')
+    parser.add_argument('--follow', '-f', action='store_true', default=False,
+                        help='Keep anonymizing lines as they are added to the log, following it when rotated')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help='Max seconds between checks of the log in follow mode, defaults to 1')
+    parser.add_argument('--stats', help='Write per ip number request, byte and status counts to this file,'
+                                        ' JSON if it ends with .json otherwise CSV')
     parser.add_argument('--verbose', '-v', action='store_true', default=False,
                         help='Verbose: output lines processed/skipped')
     args = parser.parse_args()
@@ -30,32 +103,589 @@ def main():
     else:
         skip_ips = None
     if args.output is None:
-        anonymized_path = args.log_path + '.anonymized'
+        anonymized_path = default_output(args.log_path)
     else:
         anonymized_path = args.output
+    if args.jobs > 1 and (args.log_path == '-' or args.log_path.endswith(COMPRESSED_EXTENSIONS)):
+        parser.error('--jobs requires an uncompressed log file')
+    if args.follow and (args.jobs > 1 or args.log_path == '-' or args.log_path.endswith(COMPRESSED_EXTENSIONS)):
+        parser.error('--follow requires an uncompressed log file and can not be used with --jobs')
+
+    SETTINGS['matcher'] = IPMatcher(skip_ips, args.skip_private, args.cache_size)
+    if args.mapping_db is None:
+        SETTINGS['tokens'] = MemoryTokens()
+    else:
+        SETTINGS['tokens'] = SqliteTokens(args.mapping_db, args.cache_size)
+    if args.stats is None:
+        SETTINGS['stats'] = None
+    else:
+        SETTINGS['stats'] = Stats()
+
+    try:
+        try:
+            if args.jobs > 1:
+                total, skip = parallel_anonymize(args.log_path, anonymized_path, args.jobs)
+            elif args.follow:
+                with open_log(anonymized_path, 'w') as new_file:
+                    total, skip = follow(args.log_path, new_file, args.poll_interval)
+            else:
+                with open_log(anonymized_path, 'w') as new_file:
+                    with open_log(args.log_path, 'r') as log_file:
+                        total, skip = anonymize(log_file, new_file)
+        finally:
+            SETTINGS['tokens'].close()
+    except IOError as e:
+        # The reader of stdout went away, eg piped to head. SIGPIPE is left ignored so the mapping db is flushed
+        # above, exit quietly with the status a filter killed by SIGPIPE would have.
+        if e.errno != errno.EPIPE or anonymized_path != '-':
+            raise
+        return 128 + signal.SIGPIPE
+
+    if args.stats is not None:
+        SETTINGS['stats'].write(args.stats)
+
+    if args.verbose:
+        # Keep stdout clean if it is the output
+        verbose_out = sys.stderr if anonymized_path == '-' else sys.stdout
+        verbose_out.write('Total lines processed {}, skipped {}\n'.format(total, skip))
+
+
+def default_output(log_path):
+    "The output path used when none is specified, the .anonymized extension goes before any compression one."
+    if log_path == '-':
+        return '-'
+    base, ext = os.path.splitext(log_path)
+    if ext in COMPRESSED_EXTENSIONS:
+        return base + '.anonymized' + ext
+    return log_path + '.anonymized'
+
+
+def open_log(path, mode):
+    """ Open path for reading (mode 'r') or writing (mode 'w'), '-' is stdin or stdout.
+        The compression is chosen by the file extension.
+    """
+    if path == '-':
+        stream = sys.stdin if mode == 'r' else sys.stdout
+        return os.fdopen(os.dup(stream.fileno()), mode + 'b', BUFFER_SIZE)
+
+    ext = os.path.splitext(path)[1]
+    if ext == '.gz':
+        if mode == 'r':
+            return io.BufferedReader(gzip.open(path, 'rb'), BUFFER_SIZE)
+        return io.BufferedWriter(gzip.open(path, 'wb', 6), BUFFER_SIZE)
+    elif ext == '.bz2':
+        return bz2.BZ2File(path, mode + 'b', BUFFER_SIZE)
+    elif ext in COMPRESS_COMMANDS:
+        return CommandFile(COMPRESS_COMMANDS[ext], path, mode)
+    return open(path, mode + 'b', BUFFER_SIZE)
+
+
+class CommandFile(object):
+    """ A file like object which decompresses or compresses path by piping through an external command.
+        The command must support -d to decompress and -c to write to stdout.
+    """
+    def __init__(self, command, path, mode):
+        self.command = command
+        self.out = None
+        if mode == 'r':
+            self.proc = Popen(command + ['-dc', path], stdout=PIPE, bufsize=BUFFER_SIZE)
+            self.pipe = self.proc.stdout
+        else:
+            self.out = open(path, 'wb')
+            self.proc = Popen(command + ['-c'], stdin=PIPE, stdout=self.out, bufsize=BUFFER_SIZE)
+            self.pipe = self.proc.stdin
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+    def __iter__(self):
+        return iter(self.pipe)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.pipe.close()
+        returncode = self.proc.wait()
+        if self.out is not None:
+            self.out.close()
+        if returncode != 0:
+            raise IOError('{} exited with returncode {}'.format(' '.join(self.command), returncode))
+
+
+def anonymize(lines, new_file):
+    """ Write each line to new_file with the ip replaced by its number, adding new ips to the mapping as
+        they are found. Returns a tuple of (total lines, skipped lines).
+    """
+    lookup = SETTINGS['matcher'].lookup
+    token = SETTINGS['tokens'].token
+    stats = SETTINGS['stats']
+    total = 0
+    skip = 0
+    batch = []
+    for line in lines:
+        total += 1
+        end = line.find(' ')
+        if end < 0:  # Nothing but the ip
+            end = len(line.rstrip())
+        ip = lookup(line[:end])
+        if ip is None:
+            skip += 1
+            continue
+
+        ip_token = token(ip)
+        batch.append(ip_token)
+        batch.append(line[end:])
+        if stats is not None:
+            stats.add(ip_token, line, end)
+        if len(batch) >= WRITE_BATCH:
+            new_file.writelines(batch)
+            del batch[:]
+    new_file.writelines(batch)
+
+    return total, skip
+
+
+class Stats(object):
+    """ Aggregate counts from the anonymized lines.
+        Requests, bytes and status class (1xx-5xx) counts are kept in arrays indexed by the ip number, the
+        status code histogram covers all ips. Lines where the status and size can't be found are only counted
+        as requests and in unparsed.
+    """
+    CLASSES = ('1xx', '2xx', '3xx', '4xx', '5xx')
+
+    def __init__(self):
+        self.requests = array('L')
+        self.bytes = array('L')
+        self.classes = [array('L') for status_class in self.CLASSES]
+        self.statuses = {}
+        self.unparsed = 0
+
+    def add(self, token, line, start):
+        "Count the line for the ip number token, start is the index in the line after the ip."
+        index = int(token)
+        if index >= len(self.requests):
+            self.grow(max(index + 1, len(self.requests) * 2))
+        self.requests[index] += 1
+
+        # The status and size follow the quoted request
+        quote = line.find('"', start)
+        close = line.find('" ', quote + 1)
+        fields = line[close + 2:].split(None, 2)
+        if quote < 0 or close < 0 or len(fields) < 2:
+            self.unparsed += 1
+            return
+        status, size = fields[0], fields[1]
+        if size != '-':
+            try:
+                self.bytes[index] += int(size)
+            except ValueError:
+                self.unparsed += 1
+                return
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if '1' <= status[0] <= '5':
+            self.classes[int(status[0]) - 1][index] += 1
+
+    def grow(self, length):
+        "Extend the arrays with zeros to length."
+        zeros = array('L', [0]) * (length - len(self.requests))
+        for counts in [self.requests, self.bytes] + self.classes:
+            counts.extend(zeros)
+
+    def merge(self, other):
+        "Add the counts from another Stats object."
+        if len(other.requests) > len(self.requests):
+            self.grow(len(other.requests))
+        for mine, theirs in zip([self.requests, self.bytes] + self.classes,
+                                [other.requests, other.bytes] + other.classes):
+            for index, count in enumerate(theirs):
+                if count:
+                    mine[index] += count
+        for status, count in other.statuses.iteritems():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.unparsed += other.unparsed
+
+    def rows(self):
+        "Yield a tuple of (token, requests, bytes, 1xx, 2xx, 3xx, 4xx, 5xx) for each ip number seen."
+        for index, requests in enumerate(self.requests):
+            if requests:
+                yield (index, requests, self.bytes[index]) + tuple(counts[index] for counts in self.classes)
+
+    def write(self, path):
+        """ Write the stats to path as JSON if it ends with .json otherwise as CSV.
+            The status code histogram and unparsed count are only included in the JSON.
+        """
+        if path.endswith('.json'):
+            names = ('requests', 'bytes') + self.CLASSES
+            ips = dict((row[0], dict(zip(names, row[1:]))) for row in self.rows())
+            with open(path, 'w') as stats_file:
+                json.dump({'ips': ips, 'statuses': self.statuses, 'unparsed': self.unparsed}, stats_file)
+        else:
+            with open(path, 'wb') as stats_file:
+                writer = csv.writer(stats_file)
+                writer.writerow(('ip', 'requests', 'bytes') + self.CLASSES)
+                writer.writerows(self.rows())
 
-    # Process the lines of the file
-    ips = {}
+
+class IPMatcher(object):
+    """ Decides which ips are removed from the output.
+        The skip networks are merged into sorted (first, last) integer intervals for each ip version
+        which are searched with bisect. Results are kept in an LRU cache keyed on the raw ip string.
+    """
+    def __init__(self, skip_ips=None, skip_private=False, cache_size=100000):
+        networks = []
+        if skip_ips is not None:
+            networks.extend(skip_ips.iter_cidrs())
+        if skip_private:
+            for network in PRIVATE_NETWORKS:
+                networks.extend(network.cidrs() if isinstance(network, netaddr.IPRange) else [network])
+
+        self.starts = {4: [], 6: []}
+        self.ends = {4: [], 6: []}
+        for version, first, last in sorted((net.version, net.first, net.last) for net in networks):
+            ends = self.ends[version]
+            if ends and first <= ends[-1] + 1:  # Overlapping or adjacent, merge with the previous
+                ends[-1] = max(ends[-1], last)
+            else:
+                self.starts[version].append(first)
+                ends.append(last)
+
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+    def lookup(self, raw_ip):
+        """ Returns None if the ip should be skipped otherwise the normalized ip string.
+        """
+        cache = self.cache
+        try:
+            result = cache.pop(raw_ip)
+        except KeyError:
+            result = self.match(raw_ip)
+            if len(cache) >= self.cache_size:
+                cache.popitem(last=False)  # Drop the least recently used
+        cache[raw_ip] = result
+        return result
+
+    def match(self, raw_ip):
+        "The uncached lookup"
+        ip = netaddr.IPAddress(raw_ip)
+        value = int(ip)
+        i = bisect_right(self.starts[ip.version], value) - 1
+        if i >= 0 and value <= self.ends[ip.version][i]:
+            return None
+        return str(ip)
+
+
+class MemoryTokens(dict):
+    """ Maps ips to numbers in memory only, the numbering starts over on each run.
+    """
+    def token(self, ip):
+        "Return the number for the ip as a string, assigning the next one if the ip is new."
+        try:
+            return self[ip]
+        except KeyError:
+            token = self[ip] = str(len(self))
+            return token
+
+    def connect(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteTokens(object):
+    """ Maps ips to numbers using a sqlite database so numbers are stable across runs.
+        The most recently used ips are cached in memory and newly assigned numbers are held until
+        batch_size of them are pending then inserted in a single transaction.
+        Processes sharing the database take an exclusive lock on path.lock before assigning a number and hold
+        it until the pending numbers are written, so two of them never give out the same number.
+    """
+    def __init__(self, path, cache_size=100000, batch_size=10000):
+        self.path = path
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.pending = {}
+        self.batch_size = batch_size
+        self.lock_file = open(path + '.lock', 'a')
+        self.locked = False
+        self.next_token = None
+        self.connect()
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS ips (ip TEXT PRIMARY KEY, token INTEGER NOT NULL UNIQUE)')
+            # Databases created before token was UNIQUE
+            self.db.execute('CREATE UNIQUE INDEX IF NOT EXISTS ips_token ON ips (token)')
+
+    def connect(self):
+        "Open the database, this is also called in forked workers so each has its own connection."
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+
+    def token(self, ip):
+        "Return the number for the ip as a string, assigning the next one if the ip is new."
+        cache = self.cache
+        try:
+            token = cache.pop(ip)
+        except KeyError:
+            token = self.pending.get(ip)
+            if token is None:
+                row = self.db.execute('SELECT token FROM ips WHERE ip = ?', (ip, )).fetchone()
+                if row is None and not self.locked:
+                    self.lock()
+                    # Another process may have numbered the ip while this one waited for the lock
+                    row = self.db.execute('SELECT token FROM ips WHERE ip = ?', (ip, )).fetchone()
+                if row is None:
+                    token = self.pending[ip] = str(self.next_token)
+                    self.next_token += 1
+                    if len(self.pending) >= self.batch_size:
+                        self.flush()
+                else:
+                    token = str(row[0])
+            if len(cache) >= self.cache_size:
+                cache.popitem(last=False)  # Drop the least recently used
+        cache[ip] = token
+        return token
+
+    def lock(self):
+        "Take the lock for assigning numbers, the next number is read once it is held."
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        self.locked = True
+        self.next_token = self.db.execute('SELECT COALESCE(MAX(token) + 1, 0) FROM ips').fetchone()[0]
+
+    def flush(self):
+        "Write any pending numbers to the database and release the lock."
+        if self.pending:
+            with self.db:
+                self.db.executemany('INSERT INTO ips (ip, token) VALUES (?, ?)', self.pending.iteritems())
+            self.pending.clear()
+        if self.locked:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.locked = False
+
+    def close(self):
+        self.flush()
+        self.db.close()
+        self.lock_file.close()
+
+
+def follow(log_path, new_file, poll_interval=1.0):
+    """ Anonymize log_path as lines are added until interrupted, output is flushed each time the end of the
+        log is reached. When the file at log_path is replaced the rest of the old file is read then the new
+        one is opened, if it is truncated it is read from the start. Returns a tuple of (total lines, skipped lines).
+    """
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, interrupt)
+
+    tokens = SETTINGS['tokens']
+    watcher = Watcher(os.path.dirname(os.path.abspath(log_path)))
+    log_file = None
+    partial = ''
     total = 0
     skip = 0
-    with open(anonymized_path, 'w') as new_file:
-        with open(args.log_path, 'r') as log_file:
-            for line in log_file:
-                total += 1
-                splits = line.split()
-                ip = netaddr.IPAddress(splits[0])
-                if (args.skip_private and ip.is_private()) or (skip_ips is not None and ip in skip_ips):
-                    skip += 1
+    try:
+        while True:
+            if log_file is None:
+                try:
+                    log_file = open(log_path, 'rb', 0)
+                except IOError:  # Not yet created
+                    watcher.wait(poll_interval)
                     continue
 
-                if not ips.has_key(str(ip)):
-                    ips[str(ip)] = str(len(ips))
+            data = log_file.read(BUFFER_SIZE)
+            if data:
+                lines = (partial + data).split('\n')
+                partial = lines.pop()
+                counts = anonymize([line + '\n' for line in lines if line], new_file)
+                total += counts[0]
+                skip += counts[1]
+                if len(data) < BUFFER_SIZE:  # Caught up
+                    new_file.flush()
+                    tokens.flush()
+                continue
 
-                anonymized_line = "{} {}\n".format(ips[str(ip)], ' '.join(splits[1:]))
-                new_file.write(anonymized_line)
+            # At the end of the file, check if it has been rotated or truncated before waiting
+            try:
+                current = os.stat(log_path)
+            except OSError:  # Moved but not yet recreated
+                current = None
+            if current is not None and current.st_ino != os.fstat(log_file.fileno()).st_ino:
+                if partial:  # The last line of the old file was not newline terminated
+                    counts = anonymize([partial + '\n'], new_file)
+                    total += counts[0]
+                    skip += counts[1]
+                    partial = ''
+                log_file.close()
+                log_file = None
+                continue
+            if current is not None and current.st_size < log_file.tell():
+                log_file.seek(0)
+                partial = ''
+                continue
+            watcher.wait(poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        if log_file is not None:
+            log_file.close()
 
-    if args.verbose:
-        print('Total lines processed {}, skipped {}'.format(total, skip))
+    return total, skip
+
+
+class Watcher(object):
+    """ Waits for changes to files in a directory. Inotify is used via libc if it is available
+        otherwise this falls back to sleeping for the timeout.
+    """
+    # IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENTS = 0x002 | 0x040 | 0x080 | 0x100 | 0x200
+
+    def __init__(self, directory):
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init()
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        if libc.inotify_add_watch(fd, directory, self.EVENTS) < 0:
+            os.close(fd)
+            return
+        self.fd = fd
+
+    def wait(self, timeout):
+        "Wait until something in the directory changes or timeout seconds have passed."
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        if select.select([self.fd], [], [], timeout)[0]:
+            os.read(self.fd, 65536)  # Only the wakeup matters, discard the events
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def parallel_anonymize(log_path, anonymized_path, jobs):
+    """ Anonymize the log using a pool of processes. Returns a tuple of (total lines, skipped lines).
+        The numbering matches a serial run, the first ip in the file is always 0.
+    """
+    ranges = split_ranges(log_path, jobs)
+
+    # First pass, find the ips in each range and number them in file order
+    pool = multiprocessing.Pool(jobs)
+    try:
+        range_ips = pool.map(collect_ips, [(log_path, start, end) for start, end in ranges])
+    finally:
+        pool.close()
+        pool.join()
+    tokens = SETTINGS['tokens']
+    for found in range_ips:
+        for ip in found:
+            tokens.token(ip)
+    tokens.close()  # The mapping is complete, each worker opens its own connection
+
+    # Second pass, the workers are forked after the mapping is complete so they share it
+    if anonymized_path == '-':
+        out_dir = None
+    else:
+        out_dir = os.path.dirname(os.path.abspath(anonymized_path))
+    parts = []
+    for start, end in ranges:
+        fd, part_path = tempfile.mkstemp(prefix='.anonymize-', dir=out_dir)
+        os.close(fd)
+        parts.append((log_path, start, end, part_path))
+    pool = multiprocessing.Pool(jobs, connect_worker)
+    try:
+        counts = pool.map(anonymize_range, parts)
+        if SETTINGS['stats'] is not None:
+            for count in counts:
+                SETTINGS['stats'].merge(count[2])
+        with open_log(anonymized_path, 'w') as new_file:
+            for part in parts:
+                with open(part[3], 'rb') as part_file:
+                    shutil.copyfileobj(part_file, new_file, BUFFER_SIZE)
+    finally:
+        pool.close()
+        pool.join()
+        for part in parts:
+            os.remove(part[3])
+
+    return sum(count[0] for count in counts), sum(count[1] for count in counts)
+
+
+def split_ranges(log_path, jobs):
+    """ Split the file into at most jobs (start, end) byte ranges each beginning at the start of a line.
+    """
+    size = os.path.getsize(log_path)
+    offsets = [0]
+    with open(log_path, 'rb') as log_file:
+        for i in range(1, jobs):
+            log_file.seek(max(size * i / jobs, offsets[-1]))
+            if log_file.tell() > 0:
+                log_file.seek(-1, os.SEEK_CUR)
+                log_file.readline()  # Move to the start of the next line
+            offsets.append(log_file.tell())
+    offsets.append(size)
+
+    return [(start, end) for start, end in zip(offsets[:-1], offsets[1:]) if end > start]
+
+
+def read_range(log_file, start, end):
+    "Yield the lines of log_file between the start and end byte offsets."
+    log_file.seek(start)
+    position = start
+    while position < end:
+        line = log_file.readline()
+        if not line:
+            break
+        position += len(line)
+        yield line
+
+
+def collect_ips(work):
+    "Pool worker for the first pass, returns the unskipped ips in the range ordered by first appearance."
+    log_path, start, end = work
+    lookup = SETTINGS['matcher'].lookup
+    found = {}
+    ordered = []
+    with open(log_path, 'rb') as log_file:
+        for line in read_range(log_file, start, end):
+            space = line.find(' ')
+            ip = lookup(line[:space] if space >= 0 else line.rstrip())
+            if ip is None or ip in found:
+                continue
+            found[ip] = True
+            ordered.append(ip)
+
+    return ordered
+
+
+def connect_worker():
+    "Pool initializer for the second pass, gives each worker its own mapping-db connection."
+    SETTINGS['tokens'].connect()
+
+
+def anonymize_range(work):
+    """ Pool worker for the second pass, anonymizes the range to part_path.
+        Returns a tuple of (total lines, skipped lines, Stats for the range or None).
+    """
+    log_path, start, end, part_path = work
+    if SETTINGS['stats'] is not None:
+        SETTINGS['stats'] = Stats()  # A worker can handle several ranges, only return this one's
+    with open(part_path, 'wb', BUFFER_SIZE) as new_file:
+        with open(log_path, 'rb', BUFFER_SIZE) as log_file:
+            total, skip = anonymize(read_range(log_file, start, end), new_file)
+    return total, skip, SETTINGS['stats']
 
 
 if __name__ == "__main__":
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+""" Benchmark anonymize_web_log_ips.py against a synthetic apache combined log.
+    The log is generated with a configurable number of lines, unique ips, share of ipv6 ips and share of private
+    ips. The anonymizer is run end to end the given number of times reporting lines/sec, MB/sec and peak RSS.
+    Results are appended to a JSON file so runs of different versions can be compared.
+
+    Any arguments after -- are passed on to the anonymizer, for example
+    bench_anonymize.py --lines 1000000 -- --skip_private --jobs 4
+"""
+import argparse
+from datetime import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ANONYMIZER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'anonymize_web_log_ips.py')
+AGENTS = ['Mozilla/5.0 (X11; Linux x86_64; rv:45.0) Gecko/20100101 Firefox/45.0',
+          'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+          'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0 Safari/537.36',
+          'curl/7.47.0']
+PATHS = ['/', '/index.html', '/static/site.css', '/static/app.js', '/images/logo.png', '/search?q=foo+bar',
+         '/api/v1/items/12345', '/robots.txt']
+STATUSES = ['200'] * 16 + ['304', '301', '404', '500']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', '-l', type=int, default=1000000, help='Lines in the generated log')
+    parser.add_argument('--unique', '-u', type=int, default=10000, help='Number of unique ips in the log')
+    parser.add_argument('--ipv6', type=float, default=0.1, help='Fraction of the unique ips which are ipv6')
+    parser.add_argument('--private', type=float, default=0.05, help='Fraction of the unique ips which are private')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the generated log')
+    parser.add_argument('--repeat', '-r', type=int, default=3, help='Number of times to run the anonymizer')
+    parser.add_argument('--log', help='Keep the generated log at this path, if it exists it is reused')
+    parser.add_argument('--results', default='bench_anonymize.json',
+                        help='JSON file the results are appended to, defaults to bench_anonymize.json')
+    parser.add_argument('--anonymizer', default=ANONYMIZER, help='The anonymizer script to benchmark')
+    parser.add_argument('anonymizer_args', nargs=argparse.REMAINDER,
+                        help='Arguments after -- are passed to the anonymizer')
+    args = parser.parse_args()
+    anonymizer_args = [arg for arg in args.anonymizer_args if arg != '--']
+
+    work_dir = tempfile.mkdtemp(prefix='bench_anonymize-')
+    try:
+        log_path = args.log
+        if log_path is None:
+            log_path = os.path.join(work_dir, 'access.log')
+        if not os.path.exists(log_path):
+            generate_log(log_path, args.lines, args.unique, args.ipv6, args.private, args.seed)
+        size = os.path.getsize(log_path)
+        with open(log_path, 'rb') as log_file:
+            lines = sum(1 for line in log_file)
+
+        runs = []
+        for i in range(args.repeat):
+            output = os.path.join(work_dir, 'access.log.anonymized')
+            seconds, max_rss = run(args.anonymizer, [log_path, '-o', output] + anonymizer_args)
+            runs.append({'seconds': seconds, 'lines_per_sec': lines / seconds,
+                         'mb_per_sec': size / seconds / 1048576, 'max_rss_kb': max_rss})
+            print('Run {}: {:.2f}s {:.0f} lines/sec {:.1f} MB/sec {} KB max RSS'.format(
+                i + 1, seconds, runs[-1]['lines_per_sec'], runs[-1]['mb_per_sec'], max_rss))
+    finally:
+        shutil.rmtree(work_dir)
+
+    best = min(runs, key=lambda result: result['seconds'])
+    result = {'time': datetime.utcnow().isoformat(), 'version': version(args.anonymizer),
+              'anonymizer_args': anonymizer_args, 'lines': lines, 'bytes': size, 'unique': args.unique,
+              'ipv6': args.ipv6, 'private': args.private, 'seed': args.seed, 'runs': runs, 'best': best}
+    save_result(args.results, result)
+    print('Best: {:.0f} lines/sec {:.1f} MB/sec {} KB max RSS, saved to {}'.format(
+        best['lines_per_sec'], best['mb_per_sec'], best['max_rss_kb'], args.results))
+
+
+def generate_log(path, lines, unique, ipv6, private, seed):
+    "Write a synthetic apache combined log, ips are drawn uniformly from a pool of unique ones."
+    rand = random.Random(seed)
+    pool = []
+    for i in range(unique):
+        is_v6 = rand.random() < ipv6
+        is_private = rand.random() < private
+        if is_v6 and is_private:
+            ip = 'fd00::%x:%x' % (rand.getrandbits(16), rand.getrandbits(16))
+        elif is_v6:
+            ip = '2001:db8:%x::%x:%x' % (rand.getrandbits(16), rand.getrandbits(16), rand.getrandbits(16))
+        elif is_private:
+            ip = '10.%d.%d.%d' % (rand.randint(0, 255), rand.randint(0, 255), rand.randint(1, 254))
+        else:
+            ip = '%d.%d.%d.%d' % (rand.randint(1, 223), rand.randint(0, 255), rand.randint(0, 255),
+                                  rand.randint(1, 254))
+        pool.append(ip)
+
+    start = time.mktime((2016, 1, 1, 0, 0, 0, 0, 0, 0))
+    with open(path, 'wb') as log_file:
+        batch = []
+        for i in range(lines):
+            stamp = time.strftime('%d/%b/%Y:%H:%M:%S +0000', time.gmtime(start + i / 100))
+            batch.append('%s - - [%s] "GET %s HTTP/1.1" %s %d "-" "%s"\n' % (
+                rand.choice(pool), stamp, rand.choice(PATHS), rand.choice(STATUSES), rand.randint(0, 100000),
+                rand.choice(AGENTS)))
+            if len(batch) >= 10000:
+                log_file.writelines(batch)
+                batch = []
+        log_file.writelines(batch)
+
+
+def run(anonymizer, anonymizer_args):
+    """ Run the anonymizer returning a tuple of (wall seconds, max RSS KB).
+        The RSS is that of the anonymizer process itself, for --jobs runs the pool workers are not included.
+    """
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, anonymizer] + anonymizer_args)
+    pid, status, usage = os.wait4(proc.pid, 0)
+    seconds = time.time() - start
+    if status != 0:
+        sys.exit('The anonymizer failed with status {}'.format(status))
+    return seconds, usage.ru_maxrss
+
+
+def version(anonymizer):
+    "The git revision of the anonymizer if it can be found."
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(anonymizer))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_result(path, result):
+    "Append the result to the list of results in the JSON file at path."
+    results = []
+    if os.path.exists(path):
+        with open(path, 'r') as results_file:
+            results = json.load(results_file)
+    results.append(result)
+    with open(path, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+""" Benchmark iptables-stats.py on a chain with many rules.
+    A synthetic 'iptables -L -x -n -v --line-numbers' listing is generated and the check is run end to end on it
+    the given number of times, with the iptables command replaced by reading the listing, reporting the best
+    rules/sec. The check runs in this process so --script can point at other versions of iptables-stats.py to
+    compare them. Any arguments after -- are passed on to the check, by default '-t -i -w 1000 -c 100000'.
+
+    bench_iptables_stats.py --rules 50000 -- -t -i -p
+"""
+import argparse
+import imp
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'iptables-stats.py')
+CHECK_ARGS = ['-t', '-i', '-w', '1000', '-c', '100000']
+TARGETS = ['ACCEPT'] * 3 + ['DROP', 'REJECT']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rules', '-n', type=int, default=50000, help='Rules in the generated chain')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the generated chain')
+    parser.add_argument('--repeat', '-r', type=int, default=3, help='Number of times to run the check')
+    parser.add_argument('--script', default=SCRIPT, help='The iptables-stats.py to benchmark')
+    parser.add_argument('check_args', nargs=argparse.REMAINDER, help='Arguments after -- are passed to the check')
+    args = parser.parse_args()
+    check_args = [arg for arg in args.check_args if arg != '--'] or CHECK_ARGS
+
+    work_dir = tempfile.mkdtemp(prefix='bench_iptables_stats-')
+    try:
+        listing = os.path.join(work_dir, 'listing')
+        generate_listing(listing, args.rules, args.seed)
+        check = imp.load_source('iptables_stats', args.script)
+        check.IPTABLES = 'cat ' + listing + ' #'
+        best = None
+        for i in range(args.repeat):
+            seconds, exit, output_size = run(check, check_args)
+            best = min(seconds, best or seconds)
+            print('Run {}: {:.2f}s {:.0f} rules/sec, exit {} and {} bytes of output'.format(
+                i + 1, seconds, args.rules / seconds, exit, output_size))
+    finally:
+        shutil.rmtree(work_dir)
+
+    print('Best: {:.2f}s {:.0f} rules/sec'.format(best, args.rules / best))
+
+
+def generate_listing(path, rules, seed):
+    "Write a synthetic iptables listing of an INPUT chain with the given number of rules."
+    rand = random.Random(seed)
+    with open(path, 'w') as listing:
+        listing.write('Chain INPUT (policy DROP 0 packets, 0 bytes)\n')
+        listing.write('num      pkts      bytes target     prot opt in     out     source               '
+                      'destination\n')
+        for i in range(1, rules + 1):
+            pkts = rand.randint(0, 100000)
+            listing.write('%-5d %8d %10d %-10s tcp  --  *      *       10.%d.%d.0/24         0.0.0.0/0           '
+                          'tcp dpt:%d\n' % (i, pkts, pkts * rand.randint(40, 1500), rand.choice(TARGETS),
+                                            i // 256 % 256, i % 256, rand.randint(1, 65535)))
+
+
+def run(check, check_args):
+    "Run the check returning a tuple of (seconds, exit code, bytes of output)."
+    output = tempfile.TemporaryFile()
+    stdout = sys.stdout
+    sys.stdout = output
+    start = time.time()
+    try:
+        check.main(['iptables-stats.py'] + check_args)
+        exit = 0
+    except SystemExit as e:
+        exit = e.code
+    finally:
+        seconds = time.time() - start
+        sys.stdout = stdout
+    output.seek(0, os.SEEK_END)
+    return seconds, exit, output.tell()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+""" Benchmark the nag2carbon.py perfdata parser against the naive whitespace and = split it replaced.
+    Synthetic perfdata is generated with a configurable number of metrics per check and share of quoted
+    labels and units, then both parsers convert it to carbon lines the given number of times reporting the
+    best metrics/sec of each, timed in CPU seconds. Quoted labels never contain spaces so the naive split can handle them.
+    The naive split neither validates values nor converts units, so the parser trails it, by most when many
+    values have a unit which needs scaling and formatting.
+
+    bench_perfdata.py --checks 100000 --metrics 4
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nag2carbon import perfdata_lines
+
+LABELS = ['rta', 'pl', 'time', 'size', 'load1', 'load5', 'load15', 'users', 'procs', 'connections', '/', '/var']
+UNITS = ['ms', 's', '%', 'B', 'KB', 'MB', 'c']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checks', '-n', type=int, default=100000, help='Number of perfdata strings to parse')
+    parser.add_argument('--metrics', '-m', type=int, default=4, help='Metrics in each perfdata string')
+    parser.add_argument('--quoted', type=float, default=0.2, help='Fraction of labels which are quoted')
+    parser.add_argument('--units', type=float, default=0.5, help='Fraction of values with a unit')
+    parser.add_argument('--thresholds', action='store_true', help='Also emit the threshold fields')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the generated perfdata')
+    parser.add_argument('--repeat', '-r', type=int, default=3, help='Number of times to run each parser')
+    args = parser.parse_args()
+
+    checks = generate(args.checks, args.metrics, args.quoted, args.units, args.seed)
+    metrics = args.checks * args.metrics
+    parsers = (('naive', naive_lines), ('parser', perfdata_lines))
+    best = {}
+    for i in range(args.repeat): #Interleaved so both see the same background load
+        for name, parse in parsers:
+            seconds = run(parse, checks, args.thresholds)
+            best[name] = min(seconds, best.get(name, seconds))
+    results = {}
+    for name, parse in parsers:
+        results[name] = metrics / best[name]
+        print('{}: {:.2f}s {:.0f} metrics/sec'.format(name, best[name], results[name]))
+    print('parser/naive: {:.2f}'.format(results['parser'] / results['naive']))
+
+
+def generate(checks, metrics, quoted, units, seed):
+    "Returns a list of (hostname, service, perfdata)."
+    rand = random.Random(seed)
+    generated = []
+    for i in range(checks):
+        perfs = []
+        for label in rand.sample(LABELS, metrics):
+            if rand.random() < quoted:
+                label = "'%s'" % label
+            unit = ''
+            if rand.random() < units:
+                unit = rand.choice(UNITS)
+            perfs.append('%s=%.3f%s;%d;%d;0' % (label, rand.random() * 100, unit, rand.randint(50, 80),
+                rand.randint(80, 100)))
+        generated.append(('host%d.example.com' % rand.randint(0, 999), 'Service %d' % rand.randint(0, 49),
+            ' '.join(perfs)))
+    return generated
+
+
+def naive_lines(hostname, service, pdata, now, thresholds=False):
+    "The original nag2carbon parser, thresholds are ignored."
+    hostname = hostname.replace('.', '_')
+    service = service.replace(' ', '_')
+    lines = []
+    for perf in pdata.split():
+        pname, pvalues = perf.split('=', 1)
+        pvalue = pvalues.split(';')[0]
+        lines.append("%s.%s.%s %s %d" % (hostname, service, pname, pvalue, now))
+    return lines
+
+
+def run(parse, checks, thresholds):
+    "Returns the CPU seconds taken to parse all the checks."
+    now = int(time.time())
+    start = sum(os.times()[:2])
+    for hostname, service, pdata in checks:
+        parse(hostname, service, pdata, now, thresholds)
+    return sum(os.times()[:2]) - start
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,65 +2,142 @@
 """ Check Integer via http
 This nagios plugin hits a http page which should return a simple integer in the body.
  This integer is then compared to warning/critical parameters and the output formatted appropriate for nagios.
+
+ With -k <key> the body can instead hold many values, either as JSON (nested keys are joined with '.'),
+ key=value lines or prometheus text format where the key is the metric name including any labels.
+ To let many checks share one fetch, --cache-dir keeps responses on disk. A response younger than --max-age
+ seconds is used without making a request, older ones are revalidated with a conditional request using the
+ ETag/Last-Modified headers.
+
+ Along with the value, timings and the response size are output as perfdata. The timings are cumulative from the
+ start of the request in the same manner as curl, dns and connect are 0 when a kept alive connection is reused,
+ first_byte is when the response headers were received and time is the total including any redirects.
+ Optionally warning/critical thresholds in seconds can be set on the total time.
+
+ With --daemon <socket> the checks are instead served by a long running process listening on a unix socket.
+ This avoids the interpreter startup for each check and http connections are kept open between checks.
+ check_http_int_client.py takes the same arguments and is meant to be used as the nagios command in that case.
 """
 
-import os, sys, urllib2
+import errno, hashlib, httplib, json, os, signal, socket, sys, tempfile, threading, time, urlparse
+from functools import partial
 from optparse import OptionParser
+import SocketServer
 
 VERSION='1.0'
+MAX_REDIRECTS = 5
+POOL_SIZE = 4 #Idle connections kept per host
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
 
 def main(argv=None):
     if argv is None:
         argv = sys.argv
     #Get the settings
     (options, args) = parseArgs(argv)
-    url = args[1]
+    if options.daemon is not None:
+        return serve(options.daemon)
 
+    exit, output = check(args[1], options, HTTPPool())
+    print output
+    sys.exit(exit)
+
+
+def check(url, options, pool):
+    """ Run the check returning a tuple of (exit code, nagios output line).
+        The pool is the HTTPPool used to fetch the url.
+    """
     #Hit the url, parse the thresholds
+    metrics = {}
+    start = time.time()
     try:
-        body = urllib2.urlopen(url)
-        value = int(body.read())
         crit_low, crit_high = threshold_parse(options.critical)
         warn_low, warn_high = threshold_parse(options.warning)
-    except:
-        #If the url fails return unknown
-        mesg = 'Unknown:'
+        if options.cache_dir is None:
+            body = pool.get(url, metrics, options.connect_timeout, options.read_timeout)
+        else:
+            cache = ResponseCache(options.cache_dir, options.max_age)
+            body = cache.get(pool, url, metrics, options.connect_timeout, options.read_timeout)
+        if options.key is None:
+            value = int(body)
+        else:
+            value = parse_values(body)[options.key]
+    except (IOError, httplib.HTTPException, ValueError, KeyError):
+        #If the url fails, the value isn't found or the thresholds are invalid return unknown
         value = None
         exit = 3
     else:
-        if (crit_high is not None and value > crit_high) or (crit_low is not None and value < crit_low):
-            exit = 2
-            mesg = 'Critical:'
-        elif (warn_high is not None and value > warn_high) or (warn_low is not None and value < warn_low):
-            exit = 1
-            mesg = 'Warning:'
-        else:
-            exit = 0
-            mesg = 'OK:'
+        exit = threshold_state(value, crit_low, crit_high, warn_low, warn_high)
+    metrics['time'] = time.time() - start
+    if exit != 3:
+        exit = max(exit, threshold_state(metrics['time'], None, options.time_critical, None, options.time_warning))
+    mesg = ('OK:', 'Warning:', 'Critical:', 'Unknown:')[exit]
 
     #Create the output for nagios
-    print '%s %s returned %s|value=%s' % (mesg, url, str(value), str(value))
-    sys.exit(exit)
+    perf = ['value=%s' % str(value)]
+    for name in ('dns', 'connect', 'first_byte'):
+        if name in metrics:
+            perf.append('%s=%.6fs' % (name, metrics[name]))
+    if options.time_warning is None and options.time_critical is None:
+        perf.append('time=%.6fs' % metrics['time'])
+    else:
+        perf.append('time=%.6fs;%s;%s' % (metrics['time'], options.time_warning or '', options.time_critical or ''))
+    if 'size' in metrics:
+        perf.append('size=%dB' % metrics['size'])
+    if options.key is not None:
+        url = '%s[%s]' % (url, options.key)
+    return exit, '%s %s returned %s|%s' % (mesg, url, str(value), ' '.join(perf))
 
 
-def parseArgs(argv):
-    "Parses the arguments"
-    #Define the cmdline arguments
+def threshold_state(value, crit_low, crit_high, warn_low, warn_high):
+    "Returns the nagios state, 0 OK, 1 warning or 2 critical for the value given the thresholds."
+    if (crit_high is not None and value > crit_high) or (crit_low is not None and value < crit_low):
+        return 2
+    elif (warn_high is not None and value > warn_high) or (warn_low is not None and value < warn_low):
+        return 1
+    return 0
+
+
+def makeParser():
+    "Returns the OptionParser for the check arguments"
     usage="usage: %prog -w <warning> -c <critical> <url>\n" + \
         "A number for warning or critical is treated as a max, alternatively you can specify min:max.\n" + \
         "It will then alert for value < min or value > max."
     parser = OptionParser(usage=usage, version="%prog " + VERSION)
-    parser.add_option('-w', dest='warning', default=0, help='Warning limit.')
-    parser.add_option('-c', dest='critical', default=0, help='Critical limit.')
-    #Do the actual parsing
+    parser.add_option('-w', dest='warning', help='Warning limit.')
+    parser.add_option('-c', dest='critical', help='Critical limit.')
+    parser.add_option('-k', '--key', dest='key',
+        help='Check this value from a JSON, key=value or prometheus format body rather than a single integer.')
+    parser.add_option('--cache-dir', dest='cache_dir',
+        help='Directory to cache responses in, if unset every check fetches the url.')
+    parser.add_option('--max-age', dest='max_age', type='float', default=30,
+        help='Seconds a cached response is used without revalidating it. [default: %default]')
+    parser.add_option('--time-warning', dest='time_warning', type='float',
+        help='Warning limit in seconds for the total time.')
+    parser.add_option('--time-critical', dest='time_critical', type='float',
+        help='Critical limit in seconds for the total time.')
+    parser.add_option('--connect-timeout', dest='connect_timeout', type='float', default=CONNECT_TIMEOUT,
+        help='Seconds to wait for the connection to be established. [default: %default]')
+    parser.add_option('--read-timeout', dest='read_timeout', type='float', default=READ_TIMEOUT,
+        help='Seconds to wait for data from the server once connected. [default: %default]')
+    parser.add_option('--daemon', dest='daemon', metavar='SOCKET',
+        help='Run as a daemon serving checks on this unix socket rather than running a single check.')
+    return parser
+
+def parseArgs(argv):
+    "Parses the arguments"
+    parser = makeParser()
     (options, args) = parser.parse_args(argv)
-    if len(args) < 2:
+    if len(args) < 2 and options.daemon is None:
         parser.print_usage()
         sys.exit(3)
 
     return options, args
 
 def threshold_parse(threshold):
+    "Returns a tuple of (low, high) from a threshold, either may be None. No threshold is given as None."
+    if threshold is None:
+        return None, None
     splits = threshold.split(':')
     if len(splits) == 1:
         high = int(threshold)
@@ -77,5 +154,300 @@ def threshold_parse(threshold):
 
     return low, high
 
+def parse_values(body):
+    """ Parse a body holding many values returning a dictionary of key to number.
+        JSON objects are flattened with nested keys joined by '.', otherwise each line is either key=value
+        or a prometheus sample like 'name{label="a"} value [timestamp]'. Blank and # lines are ignored.
+    """
+    stripped = body.strip()
+    if stripped.startswith('{') or stripped.startswith('['):
+        values = {}
+        flatten(json.loads(stripped), '', values)
+        return values
+
+    values = {}
+    for line in stripped.splitlines():
+        line = line.strip()
+        if len(line) == 0 or line.startswith('#'):
+            continue
+        name, sep, value = line.partition('=')
+        if sep and '{' not in name and len(name.split()) == 1: #key=value
+            values[name.strip()] = number(value.strip())
+            continue
+        if '}' in line: #prometheus with labels
+            end = line.rindex('}') + 1
+            name, rest = line[:end], line[end:].split()
+        else:
+            rest = line.split()
+            name = rest.pop(0)
+        if len(rest) == 0:
+            raise ValueError('No value found for %s' % name)
+        values[name] = number(rest[0])
+
+    return values
+
+def flatten(data, prefix, values):
+    "Add the numbers in the decoded JSON data to values, keyed by their path joined with '.'."
+    if isinstance(data, dict):
+        items = data.iteritems()
+    elif isinstance(data, list):
+        items = enumerate(data)
+    else:
+        if isinstance(data, (int, long, float)) and not isinstance(data, bool):
+            values[prefix] = data
+        return
+    for key, item in items:
+        if prefix:
+            flatten(item, '%s.%s' % (prefix, key), values)
+        else:
+            flatten(item, str(key), values)
+
+def number(value):
+    "Convert the string to an int or if that fails a float."
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+class HTTPPool(object):
+    """ Fetches urls keeping idle http keep-alive connections for reuse, keyed by scheme, host and port.
+        Redirects are followed and non 2xx responses raise IOError matching urllib2.urlopen.
+        Safe to use from multiple threads.
+    """
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, url, metrics=None, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        """ Returns the body of the url.
+            If a metrics dictionary is given the dns, connect and first_byte times of the last request
+            are set in it along with the size of the body.
+        """
+        return self.fetch(url, metrics, connect_timeout, read_timeout)[2]
+
+    def fetch(self, url, metrics=None, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, headers=None):
+        """ Returns a tuple of (status, response, body) for the url sending any extra headers given.
+            A 304 Not Modified status is returned as is, other non 2xx statuses raise IOError.
+        """
+        if metrics is None:
+            metrics = {}
+        for i in range(MAX_REDIRECTS + 1):
+            status, response, body = self.request(url, metrics, connect_timeout, read_timeout, headers)
+            location = response.getheader('location')
+            if status in (301, 302, 303, 307, 308) and location is not None:
+                url = urlparse.urljoin(url, location)
+                continue
+            if status != 304 and (status < 200 or status > 299):
+                raise IOError('%s returned HTTP status %d' % (url, status))
+            metrics['size'] = len(body)
+            return status, response, body
+        raise IOError('Too many redirects for %s' % url)
+
+    def request(self, url, metrics, connect_timeout, read_timeout, headers=None, fresh=False):
+        """ Make a GET request returning a tuple of (status, response, body). An idle connection is used if
+            there is one unless fresh is set.
+        """
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise IOError('Unsupported url %s' % url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+
+        start = time.time()
+        for name in ('dns', 'connect', 'first_byte'):
+            metrics.pop(name, None)
+        conn = None
+        if not fresh:
+            conn = self.checkout(key)
+        reused = conn is not None
+        if reused:
+            metrics['dns'] = metrics['connect'] = 0.0
+            conn.sock.settimeout(read_timeout)
+        else:
+            if parts.scheme == 'https':
+                conn = httplib.HTTPSConnection(parts.hostname, parts.port, timeout=connect_timeout)
+            else:
+                conn = httplib.HTTPConnection(parts.hostname, parts.port, timeout=connect_timeout)
+            conn._create_connection = partial(timed_connect, metrics=metrics, start=start,
+                read_timeout=read_timeout)
+        response = None
+        try:
+            request_headers = {'User-Agent': 'check_http_int/' + VERSION}
+            if headers is not None:
+                request_headers.update(headers)
+            conn.request('GET', path, headers=request_headers)
+            response = conn.getresponse()
+            metrics['first_byte'] = time.time() - start
+            body = response.read()
+        except (httplib.HTTPException, socket.error), e:
+            conn.close()
+            #The server may have closed the idle connection, if so it fails before any response. Try once more
+            #on a new connection, other errors like timeouts are not retried.
+            stale = isinstance(e, httplib.BadStatusLine) or \
+                (isinstance(e, socket.error) and e.errno in (errno.ECONNRESET, errno.EPIPE))
+            if reused and response is None and stale:
+                return self.request(url, metrics, connect_timeout, read_timeout, headers, fresh=True)
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.checkin(key, conn)
+        return response.status, response, body
+
+    def checkout(self, key):
+        "Returns an idle connection for key or None."
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                return conns.pop()
+        return None
+
+    def checkin(self, key, conn):
+        "Return a connection to the pool, closing it if the pool is full."
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.size:
+                conns.append(conn)
+                return
+        conn.close()
+
+
+class ResponseCache(object):
+    """ Caches response bodies on disk in directory, one JSON file per url.
+        A response younger than max_age seconds is returned without a request. Otherwise a conditional
+        request is made and the cached body is returned if the server replies 304 Not Modified.
+        Files are replaced atomically so the cache can be shared by concurrent checks.
+    """
+    def __init__(self, directory, max_age):
+        self.directory = directory
+        self.max_age = max_age
+
+    def get(self, pool, url, metrics, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        "Returns the body of the url, fetching it with pool if the cached copy is missing or stale."
+        path = os.path.join(self.directory, hashlib.sha1(url).hexdigest() + '.json')
+        try:
+            with open(path, 'r') as cache_file:
+                cached = json.load(cache_file)
+        except (IOError, ValueError):
+            cached = None
+        if cached is not None and time.time() - cached['time'] < self.max_age:
+            body = cached['body'].encode('latin-1')
+            metrics['size'] = len(body)
+            return body
+
+        headers = {}
+        if cached is not None:
+            if cached['etag'] is not None:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified'] is not None:
+                headers['If-Modified-Since'] = cached['last_modified']
+        status, response, body = pool.fetch(url, metrics, connect_timeout, read_timeout, headers)
+        if status == 304:
+            if cached is None:
+                raise IOError('%s returned 304 Not Modified without a cached response' % url)
+            body = cached['body'].encode('latin-1')
+            metrics['size'] = len(body)
+
+        try: #A response which can't be cached is still a good response
+            self.store(path, {'time': time.time(), 'etag': response.getheader('etag', cached and cached['etag']),
+                'last_modified': response.getheader('last-modified', cached and cached['last_modified']),
+                'body': body.decode('latin-1')})
+        except (IOError, OSError):
+            pass
+        return body
+
+    def store(self, path, cached):
+        "Write the cache entry to a temporary file and rename it into place."
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump(cached, cache_file)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            os.remove(tmp_path)
+            raise
+
+
+def timed_connect(address, timeout, source_address=None, metrics=None, start=None, read_timeout=None):
+    """ A replacement for socket.create_connection which records the time taken for the dns lookup and
+        connection in metrics relative to start. Once connected the socket timeout is set to read_timeout.
+    """
+    host, port = address
+    addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    metrics['dns'] = time.time() - start
+    error = socket.error('No addresses found for %s' % host)
+    for family, socktype, proto, canonname, sockaddr in addresses:
+        sock = socket.socket(family, socktype, proto)
+        sock.settimeout(timeout)
+        if source_address:
+            sock.bind(source_address)
+        try:
+            sock.connect(sockaddr)
+        except socket.error, e:
+            sock.close()
+            error = e
+            continue
+        metrics['connect'] = time.time() - start
+        sock.settimeout(read_timeout)
+        return sock
+    raise error
+
+
+class CheckHandler(SocketServer.BaseRequestHandler):
+    """ Handles a single check from check_http_int_client.py.
+        The request is the check arguments separated by null bytes, the client shuts down its side of the
+        socket when done sending. The response is the exit code then the nagios output on separate lines.
+    """
+    def handle(self):
+        chunks = []
+        while True:
+            data = self.request.recv(4096)
+            if not data:
+                break
+            chunks.append(data)
+        data = ''.join(chunks)
+        argv = [sys.argv[0]]
+        if data:
+            argv.extend(data.split('\0'))
+        try:
+            options, args = parseArgs(argv)
+            if options.daemon is not None:
+                raise SystemExit(3)
+            exit, output = check(args[1], options, self.server.pool)
+        except SystemExit:
+            exit, output = 3, 'Unknown: invalid arguments %s' % ' '.join(argv[1:])
+        self.request.sendall('%d\n%s\n' % (exit, output))
+
+
+class CheckServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    "Serves checks on a unix socket, sharing one HTTPPool among all of them."
+    daemon_threads = True
+
+    def __init__(self, path):
+        if os.path.exists(path): #Remove a stale socket
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, CheckHandler)
+        self.pool = HTTPPool()
+
+
+def serve(path):
+    "Serve checks on the unix socket at path until interrupted or terminated."
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, interrupt)
+
+    server = CheckServer(path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+    return 0
+
 if __name__ == "__main__":
     sys.exit(main())
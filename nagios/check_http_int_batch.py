@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+""" Batch Check Integer via http
+    Runs the check_http_int.py check against many urls concurrently. The urls are read from a targets file
+    with one target per line in the form
+        <url> <warning> <critical> [<host> <service description>]
+    Blank lines and lines starting with # are ignored. The warning and critical thresholds have the same
+    format as check_http_int.py.
+
+    Results are written as passive service check results to the nagios external command file, which requires
+    the host and service on each target, or otherwise as a JSON report.
+    The checks are run from a bounded pool of threads sharing keep-alive connections to each host.
+"""
+
+import json, os, sys, threading, time
+from optparse import OptionParser
+import Queue
+
+from check_http_int import check, CONNECT_TIMEOUT, HTTPPool, makeParser, READ_TIMEOUT
+
+VERSION='1.0'
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    (options, args) = parseArgs(argv)
+
+    try:
+        targets = parseTargets(args[1])
+    except (IOError, ValueError), e:
+        print 'Error reading targets: %s' % e
+        return 3
+
+    results = runChecks(targets, options)
+
+    if options.command_file is not None:
+        writeCommands(options.command_file, targets, results)
+    else:
+        report = []
+        for target, (exit, output) in zip(targets, results):
+            report.append({'url': target['url'], 'host': target['host'], 'service': target['service'],
+                'exit': exit, 'output': output})
+        if options.json == '-':
+            json.dump(report, sys.stdout, indent=2)
+            print
+        else:
+            with open(options.json, 'w') as json_file:
+                json.dump(report, json_file, indent=2)
+
+
+def parseArgs(argv):
+    "Parses the arguments"
+    usage="usage: %prog [options] <targets file>"
+    parser = OptionParser(usage=usage, version="%prog " + VERSION)
+    parser.add_option('-n', '--concurrency', dest='concurrency', type='int', default=50,
+        help='Number of checks to run at once. [default: %default]')
+    parser.add_option('--connect-timeout', dest='connect_timeout', type='float', default=CONNECT_TIMEOUT,
+        help='Seconds to wait for each connection to be established. [default: %default]')
+    parser.add_option('--read-timeout', dest='read_timeout', type='float', default=READ_TIMEOUT,
+        help='Seconds to wait for data from each server once connected. [default: %default]')
+    parser.add_option('--command-file', dest='command_file',
+        help='Write passive check results to this nagios external command file.')
+    parser.add_option('--json', dest='json', default='-',
+        help='Write a JSON report to this file, used if --command-file is not set. [default: stdout]')
+    (options, args) = parser.parse_args(argv)
+    if len(args) < 2:
+        parser.print_usage()
+        sys.exit(3)
+
+    return options, args
+
+def parseTargets(path):
+    """ Read the targets file returning a list of dictionaries with url, warning, critical, host and service.
+        Host and service are None if not specified.
+    """
+    targets = []
+    with open(path, 'r') as targets_file:
+        for linenum, line in enumerate(targets_file, 1):
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            words = line.split(None, 4)
+            if len(words) == 4 or len(words) < 3:
+                raise ValueError('line %d should be <url> <warning> <critical> [<host> <service>]' % linenum)
+            target = {'url': words[0], 'warning': words[1], 'critical': words[2], 'host': None, 'service': None}
+            if len(words) == 5:
+                target['host'] = words[3]
+                target['service'] = words[4]
+            targets.append(target)
+
+    return targets
+
+def runChecks(targets, options):
+    """ Run the checks using options.concurrency threads returning a list of (exit code, output) in the same
+        order as targets.
+    """
+    concurrency = options.concurrency
+    pool = HTTPPool(concurrency)
+    results = [None] * len(targets)
+    work = Queue.Queue()
+    for index, target in enumerate(targets):
+        work.put(index)
+
+    def worker():
+        while True:
+            try:
+                index = work.get_nowait()
+            except Queue.Empty:
+                return
+            target = targets[index]
+            check_options = makeParser().get_default_values()
+            check_options.warning = target['warning']
+            check_options.critical = target['critical']
+            check_options.connect_timeout = options.connect_timeout
+            check_options.read_timeout = options.read_timeout
+            results[index] = check(target['url'], check_options, pool)
+
+    threads = []
+    for i in range(min(concurrency, len(targets))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    return results
+
+def writeCommands(path, targets, results):
+    """ Write PROCESS_SERVICE_CHECK_RESULT commands to the nagios command file.
+        Each command is a single write so they aren't interleaved with other writers. Targets without
+        a host and service are skipped.
+    """
+    now = int(time.time())
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    try:
+        for target, (exit, output) in zip(targets, results):
+            if target['host'] is None:
+                print 'Skipping %s, no host and service specified' % target['url']
+                continue
+            os.write(fd, '[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n' %
+                (now, target['host'], target['service'], exit, output))
+    finally:
+        os.close(fd)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+""" Client for check_http_int.py running with --daemon
+    Takes the same arguments as check_http_int.py, passes them to the daemon and prints its output exiting
+    with the same code so it can be used directly as the nagios command. Only the socket module is imported
+    to keep the startup cost low, running it with 'python -S' also skips the site import.
+
+    The socket path defaults to SOCKET and can be changed with --socket=<path> as the first argument.
+"""
+
+import socket
+import sys
+
+SOCKET = '/var/run/nagios/check_http_int.sock'
+TIMEOUT = 60
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    path = SOCKET
+    args = argv[1:]
+    if args and args[0].startswith('--socket='):
+        path = args.pop(0).split('=', 1)[1]
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(TIMEOUT)
+    try:
+        sock.connect(path)
+        sock.sendall('\0'.join(args))
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            chunks.append(data)
+    except socket.error, e:
+        print 'Unknown: check_http_int daemon at %s failed: %s' % (path, e)
+        return 3
+    finally:
+        sock.close()
+
+    response = ''.join(chunks)
+    if '\n' not in response:
+        print 'Unknown: check_http_int daemon at %s returned no result' % path
+        return 3
+    exit, output = response.split('\n', 1)
+    sys.stdout.write(output)
+    return int(exit)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -31,14 +31,76 @@
  my sudoers setup.
 
  nagios   ALL=NOPASSWD: /sbin/iptables -L *
+ nagios   ALL=NOPASSWD: /sbin/iptables-save -c
+ nagios   ALL=NOPASSWD: /usr/sbin/nft -j list ruleset
+
+ Zeroing the counters means only one check can use them and the -s division assumes the check ran exactly
+ that many seconds after the last one. With --rate the counters aren't zeroed, instead each sample is saved
+ with its time in a state file and the output is the per second rate since the previous sample. Rules are
+ identified in the state file by table, chain and the rule itself rather than its number so inserting or
+ deleting rules doesn't mix up their counts. A counter lower than in the previous sample means the counters
+ were reset, the new count is used as the increase. Give each check its own --state-file if several check
+ the same chain at different intervals. The state file should be in a directory only the nagios user can
+ write to, like the default /var/lib/nagios.
+
+ Checking several chains with one process per chain walks the rules once per chain. With -S (--select),
+ which can be repeated, a single 'iptables-save -c' snapshot of every table is parsed into an index and each
+ selected chain is checked from it. These counters aren't zeroed, without --rate they are the counts since
+ the counters were last reset. By default the results are combined into one output with the message items
+ and perfdata labels prefixed by table/chain, with --command-file and -H each chain is submitted as a passive
+ check result instead. The rule keys differ from those of the -L output so switching a chain between the
+ two with --rate counts all its rules from zero once.
+
+ --source picks where --select reads the counters from: iptables-save (the default), iptables, which lists
+ each selected table with 'iptables -L' without zeroing it, or nft, which reads the whole nftables ruleset
+ as JSON from 'nft -j list ruleset'. nftables tables are named '<family> <name>', like 'inet filter/input',
+ or just by name if only one family has it. Rules can be selected by line number, by nftables handle like
+ #12 or by comment, for example -S 'inet filter/input:#12,ssh'. Only nftables rules with a counter are
+ reported.
+
+ Running a plugin every few seconds to graph the counters is costly, instead --collect runs as a daemon
+ sampling the selected chains from the counter source every --interval seconds without zeroing them. The
+ per second rate of each rule since the previous sample is computed in memory and sent in one batch to the
+ carbon plaintext port given with --carbon, as <--metric-prefix>.<table>.<chain>.<rule>.packets and .bytes
+ where the rule is its comment, nftables handle or number. With --spool the batch is appended to a
+ nag2carbon.py spool file instead so nag2carbon.py --relay --buffer can ship it without losing data while
+ carbon is down, a batch which can't be sent with --carbon is dropped. Errors reading the counters or
+ writing the output are logged to stderr and the collector carries on with the next sample. The latest rates
+ are also written to --latest and a check run with --collected and the same --select options reports on them
+ rather than running iptables itself, Unknown if the collector hasn't written them for --max-age seconds.
+
+ iptables-stats.py --collect --interval 10 --carbon graphite:2003 -S INPUT -S nat/PREROUTING
+ iptables-stats.py --collected -t -i -w 1000 -c 5000 -S INPUT
 
 """
 
-import os, sys
+import fcntl, json, os, re, socket, sys, tempfile, time
 from optparse import OptionParser
 
 VERSION='1.0'
 IPTABLES='/usr/bin/sudo /sbin/iptables'
+IPTABLES_SAVE='/usr/bin/sudo /sbin/iptables-save'
+NFT='/usr/bin/sudo /usr/sbin/nft'
+NFT_VERDICTS=('accept', 'drop', 'reject', 'jump', 'goto', 'return', 'queue')
+COMMENT_LIST_RE=re.compile(r'/\* (.*?) \*/')
+COMMENT_SAVE_RE=re.compile(r'--comment (?:"((?:[^"\\]|\\.)*)"|(\S+))')
+STATE_FILE='/var/lib/nagios/iptables-stats.state'
+SERVICE_FORMAT='iptables %(table)s %(chain)s'
+COLLECT_INTERVAL=10 #Seconds between samples with --collect
+LATEST_FILE='/var/lib/nagios/iptables-stats.latest'
+METRIC_PREFIX='iptables.%s' #Formatted with the hostname
+CARBON_TIMEOUT=5
+NAME_RE=re.compile(r'[^\w-]+')
+STATES=('OK:', 'Warning:', 'Critical:', 'Unknown:')
+#The counters which can be output as (option enabling them, column in the results, warning limit option,
+#critical limit option, labels). The labels for accepted (True) and blocked (False) are (total message label,
+#total perfdata label, index in getTotals, rule message label, rule perfdata label)
+COUNTERS=(('packets', 1, 'packetWarning', 'packetCritical',
+           {True: ('Accepted Packet Total', 'Total Packets Accepted', 0, 'Accepted Packets', 'Packets Accepted'),
+            False: ('Blocked Packet Total', 'Total Packets Blocked', 2, 'Packet Total', 'Packets Blocked')}),
+          ('bytes', 2, 'byteWarning', 'byteCritical',
+           {True: ('Accepted Bytes Total', 'Total Bytes Accepted', 1, 'Accepted Bytes', 'Bytes Accepted'),
+            False: ('Blocked Bytes Total', 'Total Bytes Blocked', 3, 'Bytes Total', 'Bytes Blocked')}))
 
 def main(argv=None):
     if argv is None:
@@ -46,141 +108,98 @@ def main(argv=None):
     #Get the settings
     options = parseArgs(argv)
 
-    #Run the command
-    outpipe=os.popen(IPTABLES + ' -L ' + options.chain + ' -Z -x -n -v --line-numbers -t ' + options.table, 'r')
+    if options.collect:
+        collect(options)
+
+    if options.selections:
+        try:
+            checks = snapshot(options)
+        except (IOError, ValueError), e:
+            print 'Unknown: Could not read the counters, %s|' % e
+            sys.exit(3)
+        exit = max([check[1] for check in checks])
+        if options.commandFile is not None:
+            writeCommands(options.commandFile, options.host, options.serviceFormat, checks)
+            print STATES[exit] + ' Submitted results for ' + str(len(checks)) + ' chains|'
+        else:
+            print STATES[exit] + ''.join([check[2] for check in checks]) + '|' + ' '.join([check[3].strip() for check in checks if check[3]])
+        sys.exit(exit)
+
+    #Run the command, the counters are only zeroed if not computing rates
+    if options.rate:
+        zero = ''
+    else:
+        zero = ' -Z'
+    outpipe=os.popen(IPTABLES + ' -L ' + options.chain + zero + ' -x -n -v --line-numbers -t ' + options.table, 'r')
 
     #parse the Output
-    results = parseOutput(outpipe, options.rules, options.seconds)
+    if options.rate:
+        chainKey = options.table + '/' + options.chain
+        counters = parseCounters(outpipe)
+        try:
+            (previous, now) = saveSamples(options.stateFile, {chainKey: counters})
+        except (IOError, OSError), e:
+            print 'Unknown: Could not save the sample to %s, %s|' % (options.stateFile, e)
+            sys.exit(3)
+        results = rateResults(counters, previous[chainKey], now, options.rules)
+        if results is None:
+            print 'OK: First sample saved, rates will be available from the next check|'
+            sys.exit(0)
+    else:
+        results = parseOutput(outpipe, options.rules, options.seconds)
     if options.verbose:
         for line in results:
             print 'Line number:' + str(line[0]) + ' Packets:' + str(line[1]) + ' Bytes:' + str(line[2]) \
             + ' Accepted:' + str(line[3])
 
-    if options.totals:
-        (totalPktsAccepted, totalBytesAccepted, totalPktsBlocked, totalBytesBlocked) = getTotals(results)
+    (exit, mesg, perf) = buildOutput(results, options)
 
-    #begin building the output lines and checking the limits based on the options
-    mesg=''
-    perf=''
-    exit=0 #0 okay, 1 warning, 2 critical, 3 unknown
-    #bytes/packets or both, totals or individuals
-    if options.packets:
-        if options.totals:
-            if options.accepted:
-                if options.packetCritical != 0 and totalPktsAccepted > options.packetCritical:
-                    mesg = mesg + ' Critical! '
-                    if exit < 2:
-                        exit = 2
-                elif options.packetWarning !=0 and totalPktsAccepted > options.packetWarning:
-                    mesg = mesg + ' WARNING! '
-                    if exit < 1:
-                        exit = 1
-                mesg = mesg + ' Accepted Packet Total:' + str(totalPktsAccepted)
-                perf = perf + " 'Total Packets Accepted'=" + str(totalPktsAccepted) +";" \
-                + str(options.packetWarning) + ";" + str(options.packetCritical)
-            if options.blocked:
-                if options.packetCritical != 0 and totalPktsBlocked > options.packetCritical:
-                    mesg = mesg + ' Critical! '
-                    if exit < 2:
-                        exit = 2
-                elif options.packetWarning !=0 and totalPktsBlocked > options.packetWarning:
-                    mesg = mesg + ' WARNING! '
-                    if exit < 1:
-                        exit = 1
-                mesg = mesg + ' Blocked Packet Total:' + str(totalPktsBlocked)
-                perf = perf + " 'Total Packets Blocked'=" + str(totalPktsBlocked) \
-                + ";" + str(options.packetWarning) + ";" + str(options.packetCritical)
-        if options.individuals:
-            for line in results:
-                if options.accepted and line[3]:
-                    if options.packetCritical != 0 and line[1] > options.packetCritical:
-                        mesg = mesg + ' Critical! '
-                        if exit < 2:
-                            exit = 2
-                    elif options.packetWarning !=0 and line[1] > options.packetWarning:
-                        mesg = mesg + ' WARNING! '
-                        if exit < 1:
-                            exit = 1
-                    mesg = mesg + ' Rule ' + str(line[0]) + ' Accepted Packets:' + str(line[1])
-                    perf = perf + " 'Rule " + str(line[0]) + " Packets Accepted'=" + str(line[1]) + ";" \
-                    + str(options.packetWarning) + ";" + str(options.packetCritical)
-                if options.blocked and not line[3]:
-                    if options.packetCritical != 0 and line[1] > options.packetCritical:
-                        mesg = mesg + ' Critical! '
-                        if exit < 2:
-                            exit = 2
-                    elif options.packetWarning !=0 and line[1] > options.packetWarning:
-                        mesg = mesg + ' WARNING! '
-                        if exit < 1:
-                            exit = 1
-                    mesg = mesg + ' Rule ' + str(line[0]) + ' Packet Total:' + str(line[1])
-                    perf = perf + " 'Rule " + str(line[0]) + " Packets Blocked'=" + str(line[1]) + ";" \
-                    + str(options.packetWarning) + ";" + str(options.packetCritical)
-    if options.bytes:
+    #print the message and exit
+    print STATES[exit] + mesg + '|' + perf
+    sys.exit(exit)
+
+
+def buildOutput(results, options, prefix=''):
+    """ Build the message and perfdata for the results checking the limits based on the options.
+        The prefix is added to each message item and perfdata label. Returns a tuple (exit code, message, perfdata)
+    """
+    #Collect every metric to output as (message label, perfdata label, value, warning, critical)
+    metrics = []
+    dispositions = [accepted for accepted, enabled in ((True, options.accepted), (False, options.blocked)) if enabled]
+    totals = getTotals(results)
+    for enabled, column, warningName, criticalName, labels in COUNTERS:
+        if not getattr(options, enabled):
+            continue
+        warning = getattr(options, warningName)
+        critical = getattr(options, criticalName)
         if options.totals:
-            if options.accepted:
-                if options.byteCritical != 0 and totalPktsAccepted > options.byteCritical:
-                    mesg = mesg + ' Critical! '
-                    if exit < 2:
-                        exit = 2
-                    elif options.byteWarning != 0 and totalPktsAccepted > options.byteWarning:
-                        mesg = mesg + ' WARNING! '
-                    if exit < 1:
-                        exit = 1
-                mesg = mesg + ' Accepted Bytes Total:' + str(totalPktsAccepted)
-                perf = perf + " 'Total Bytes Accepted'=" + str(totalPktsAccepted) + ";" + str(options.byteWarning) \
-                + ";" + str(options.byteCritical)
-            if options.blocked:
-                if options.byteCritical != 0 and totalPktsBlocked > options.byteCritical:
-                    mesg = mesg + ' Critical! '
-                    if exit < 2:
-                        exit = 2
-                elif options.byteWarning != 0 and totalPktsBlocked > options.byteWarning:
-                    mesg = mesg + ' WARNING! '
-                    if exit < 1:
-                        exit = 1
-                mesg = mesg + ' Blocked Bytes Total:' + str(totalPktsBlocked)
-                perf = perf + " 'Total Bytes Blocked'=" + str(totalPktsBlocked) + ";" + str(options.byteWarning) \
-                + ";" + str(options.byteCritical)
+            for accepted in dispositions:
+                mesgLabel, perfLabel, total = labels[accepted][:3]
+                metrics.append((mesgLabel, perfLabel, totals[total], warning, critical))
         if options.individuals:
+            ruleMesg = dict((accepted, labels[accepted][3]) for accepted in dispositions)
+            rulePerf = dict((accepted, labels[accepted][4]) for accepted in dispositions)
             for line in results:
-                if options.accepted and line[3]:
-                    if options.byteCritical != 0 and line[1] > options.byteCritical:
-                        mesg = mesg + ' Critical! '
-                        if exit < 2:
-                            exit = 2
-                    elif options.byteWarning != 0 and line[1] > options.byteWarning:
-                        mesg = mesg + ' WARNING! '
-                        if exit < 1:
-                            exit = 1
-                    mesg = mesg + ' Rule ' + str(line[0]) + ' Accepted Bytes:' + str(line[1])
-                    perf = perf + " 'Rule " + str(line[0]) + " Bytes Accepted'=" + str(line[1]) + ";" \
-                    + str(options.byteWarning) + ";" + str(options.byteCritical)
-                if options.blocked and not line[3]:
-                    if options.byteCritical != 0 and line[1] > options.byteCritical:
-                        mesg = mesg + ' Critical! '
-                        if exit < 2:
-                            exit = 2
-                    elif options.byteWarning != 0 and line[1] > options.byteWarning:
-                        mesg = mesg + ' WARNING! '
-                        if exit < 1:
-                            exit = 1
-                    mesg = mesg + ' Rule ' + str(line[0]) + ' Bytes Total:' + str(line[1])
-                    perf = perf + " 'Rule " + str(line[0]) + " Bytes Blocked'=" + str(line[1]) + ";" \
-                    + str(options.byteWarning) + ";" + str(options.byteCritical)
+                if line[3] in ruleMesg:
+                    rule = 'Rule ' + str(line[0]) + ' '
+                    metrics.append((rule + ruleMesg[line[3]], rule + rulePerf[line[3]], line[column], warning, critical))
 
-    #print the message and exit
-    if exit == 0:
-        state = 'OK:'
-    elif exit == 1:
-        state = 'Warning:'
-    elif exit == 2:
-        state = 'Critical:'
-    elif exit == 3:
-        state = 'Unknown:'
-    print state + mesg + '|' + perf
-    sys.exit(exit)
+    #Check them all against their limits and join the output once
+    exit = 0 #0 okay, 1 warning, 2 critical, 3 unknown
+    mesg = []
+    perf = []
+    for mesgLabel, perfLabel, value, warning, critical in metrics:
+        if critical != 0 and value > critical:
+            mesg.append(' Critical! ')
+            exit = 2
+        elif warning != 0 and value > warning:
+            mesg.append(' WARNING! ')
+            if exit < 1:
+                exit = 1
+        mesg.append(' ' + prefix + mesgLabel + ':' + str(value))
+        perf.append(" '" + prefix + perfLabel + "'=" + str(value) + ';' + str(warning) + ';' + str(critical))
 
+    return exit, ''.join(mesg), ''.join(perf)
 
 def getTotals(results):
     "Add up the totals, returns total accpeted and total dropped for bytes and packets"
@@ -222,6 +241,21 @@ def parseArgs (argv):
     parser.add_option('-b', '--byte-only', dest='packets', action="store_false", default=True, help='Output byte count only. [default: packets and bytes]')
     parser.add_option('-r', '--rule', dest='rules', type='int', action='append', help='Rule to use in counts. Can be specified multiple times, like "-r 1 -r 3" [default: All rules in the chain]')
     parser.add_option('-s', '--seconds', dest='seconds', type='int', help='If specified the counts will be divided byt this number to give bytes per second or packets per second.')
+    parser.add_option('--rate', dest='rate', action='store_true', default=False, help='Output per second rates since the previous check without zeroing the counters.')
+    parser.add_option('--state-file', dest='stateFile', default=STATE_FILE, help='Where the previous sample is kept for --rate. [default: %default]')
+    parser.add_option('-S', '--select', dest='selections', action='append', default=[], help='Check this chain from a single snapshot of the counters, like [table/]chain[:rule,rule]. Can be specified multiple times, the table and rules default to -T and -r.')
+    parser.add_option('--source', dest='source', default='iptables-save', choices=sorted(COUNTER_SOURCES.keys()), help='Where --select reads the counters from, one of ' + ', '.join(sorted(COUNTER_SOURCES.keys())) + '. [default: %default]')
+    parser.add_option('--command-file', dest='commandFile', help='With --select write a passive check result for each chain to this nagios external command file.')
+    parser.add_option('-H', '--host', dest='host', help='Host the passive check results are for.')
+    parser.add_option('--service-format', dest='serviceFormat', default=SERVICE_FORMAT, help='Service description of the passive check results, %(table)s and %(chain)s are replaced. [default: %default]')
+    parser.add_option('--collect', dest='collect', action='store_true', default=False, help='Run as a daemon sending per second rates of the --select chains to carbon or a spool file.')
+    parser.add_option('--interval', dest='interval', type='float', default=COLLECT_INTERVAL, help='Seconds between samples with --collect. [default: %default]')
+    parser.add_option('--carbon', dest='carbon', metavar='HOST:PORT', help='Send the --collect metrics to this carbon plaintext port.')
+    parser.add_option('--spool', dest='spool', help='Append the --collect metrics to this nag2carbon.py spool file.')
+    parser.add_option('--metric-prefix', dest='metricPrefix', help='Prefix of the --collect metrics. [default: %s]' % (METRIC_PREFIX % '<hostname>'))
+    parser.add_option('--latest', dest='latest', default=LATEST_FILE, help='Where --collect writes the latest rates for --collected. [default: %default]')
+    parser.add_option('--collected', dest='collected', action='store_true', default=False, help='Check the --select chains using the latest rates written by --collect.')
+    parser.add_option('--max-age', dest='maxAge', type='float', help='Seconds after which the --collected rates are stale. [default: 3 --collect intervals]')
     parser.add_option("-v", action="store_true", default=False, dest="verbose", help="Verbose")
 
     #Do the actual parsing
@@ -243,8 +277,49 @@ def parseArgs (argv):
         parser.print_help()
         sys.exit(3)
 
+    if options.rate and options.seconds != None:
+        print "--rate and -s (--seconds) are mutually exclusive."
+        parser.print_help()
+        sys.exit(3)
+
+    if options.selections and options.seconds != None:
+        print "--select and -s (--seconds) are mutually exclusive."
+        parser.print_help()
+        sys.exit(3)
+    if options.commandFile is not None and options.host is None:
+        print "--command-file requires -H (--host)."
+        parser.print_help()
+        sys.exit(3)
+    if (options.collect or options.collected) and not options.selections:
+        print "--collect and --collected require -S (--select)."
+        parser.print_help()
+        sys.exit(3)
+    if options.collected and options.rate:
+        print "--collected and --rate are mutually exclusive, the collected counters are already rates."
+        parser.print_help()
+        sys.exit(3)
+    if options.carbon is not None:
+        try:
+            host, port = options.carbon.rsplit(':', 1)
+            options.carbon = (host, int(port))
+        except ValueError:
+            print "Invalid --carbon " + options.carbon + ", should be like host:port"
+            parser.print_help()
+            sys.exit(3)
+    if options.metricPrefix is None:
+        options.metricPrefix = METRIC_PREFIX % NAME_RE.sub('_', socket.gethostname())
+    if options.rules != None:
+        options.rules = set(options.rules)
+    try:
+        for selection in options.selections:
+            parseSelection(selection, options.table, options.rules)
+    except ValueError:
+        print "Invalid --select " + selection + ", should be like [table/]chain[:rule,rule]"
+        parser.print_help()
+        sys.exit(3)
+
     #require -t or -i or both
-    if options.totals == False and options.individuals == False:
+    if options.totals == False and options.individuals == False and not options.collect:
         print "Options -t (--totals) and/or -i (--individuals) required."
         parser.print_help()
         sys.exit(3)
@@ -296,5 +371,472 @@ def parseOutput(out, rules, seconds):
 
     return tuple(results)
 
+def parseCounters(out):
+    """ Takes a file object or list of lines of the rules in one chain as input and parses it. Returns a list like
+        [(line number, packet count, byte count, target, rule key, names)]
+        The rule key is the rule without its number or counts, a count is added to rules which are duplicated
+        so every key is unique. Names is a tuple of the other names the rule can be selected by, its comment.
+    """
+    counters = []
+    seen = {}
+    for line in out:
+        words = line.split()
+        #skip lines that don't start with a number, these are headers and footers
+        try:
+            linenum = int(words[0])
+        except:
+            continue
+        key = ' '.join(words[3:])
+        seen[key] = seen.get(key, 0) + 1
+        if seen[key] > 1:
+            key = key + ' #' + str(seen[key])
+        names = ()
+        comment = COMMENT_LIST_RE.search(line)
+        if comment is not None:
+            names = (comment.group(1),)
+        counters.append((linenum, int(words[1]), int(words[2]), words[3], key, names))
+
+    return counters
+
+def parseList(out):
+    """ Parse iptables -L -x -n -v --line-numbers output for every chain in a table into an index like
+        {chain: counters from parseCounters}
+    """
+    index = {}
+    chain = None
+    lines = []
+    for line in out:
+        if line.startswith('Chain '):
+            if chain is not None:
+                index[chain] = parseCounters(lines)
+            chain = line.split()[1]
+            lines = []
+        else:
+            lines.append(line)
+    if chain is not None:
+        index[chain] = parseCounters(lines)
+
+    return index
+
+def writeJSON(path, data):
+    "Write data as JSON to a temporary file in the same directory then rename it over path."
+    fd, tmpFile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp')
+    try:
+        os.fchmod(fd, 0644)
+        with os.fdopen(fd, 'w') as out:
+            json.dump(data, out)
+        os.rename(tmpFile, path)
+    except (IOError, OSError):
+        os.remove(tmpFile)
+        raise
+
+def saveSamples(stateFile, samples):
+    """ Save the samples, a dictionary of 'table/chain' to counters from parseCounters, in the state file.
+        Returns a tuple of (dictionary of 'table/chain' to the previous sample or None, time of the samples)
+    """
+    now = time.time()
+    previous = {}
+    lock = open(stateFile + '.lock', 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX) #Other checks may be updating other chains in the same state file
+        try:
+            with open(stateFile, 'r') as stateIn:
+                state = json.load(stateIn)
+        except (IOError, ValueError):
+            state = {}
+        for chainKey, counters in samples.items():
+            previous[chainKey] = state.get(chainKey)
+            state[chainKey] = sample(counters, now)
+        writeJSON(stateFile, state)
+    finally:
+        lock.close()
+
+    return previous, now
+
+def sample(counters, now):
+    "Returns the sample of the counters kept to compute rates from, {'time': now, 'rules': {rule key: [pkts, bytes]}}"
+    return {'time': now, 'rules': dict((counter[4], [counter[1], counter[2]]) for counter in counters)}
+
+def rateCounters(counters, previous, now):
+    """ Returns the counters with their counts replaced by the per second rates since the previous sample or None
+        if there is no previous sample.
+    """
+    if previous is None or now <= previous['time']:
+        return None
+    seconds = now - previous['time']
+    rates = []
+    for linenum, pkts, bytes, target, key, names in counters:
+        #New rules and counters lower than last time, meaning they were reset, count from zero
+        previousPkts, previousBytes = previous['rules'].get(key, (0, 0))
+        if pkts >= previousPkts and bytes >= previousBytes:
+            pkts = pkts - previousPkts
+            bytes = bytes - previousBytes
+        rates.append((linenum, round(pkts / seconds, 2), round(bytes / seconds, 2), target, key, names))
+
+    return rates
+
+def rateResults(counters, previous, now, rules):
+    """ Compute the per second rates since the previous sample. Returns a tuple like parseOutput or None if
+        there is no previous sample.
+    """
+    rates = rateCounters(counters, previous, now)
+    if rates is None:
+        return None
+    return countResults(rates, rules)
+
+def countResults(counters, rules):
+    "Returns a tuple like parseOutput from the counters."
+    results = []
+    for linenum, pkts, bytes, target, key, names in selected(counters, rules):
+        results.append((linenum, pkts, bytes, target == 'ACCEPT'))
+    return tuple(results)
+
+def selected(counters, rules):
+    "Returns the counters for the rules, a set of line numbers and names, or all of them if rules is None."
+    if rules == None:
+        return counters
+    return [counter for counter in counters if counter[0] in rules or rules.intersection(counter[5])]
+
+def parseSave(out):
+    """ Parse iptables-save -c output in one pass into an index like
+        {table: {chain: [(rule number, packet count, byte count, target, rule key, names)]}}
+        The rule key is the rule without its counters and chain, duplicates are made unique and names is the
+        comment if any as in parseCounters.
+    """
+    index = {}
+    chains = {}
+    seen = {}
+    for line in out:
+        if line.startswith('*'):
+            chains = index.setdefault(line[1:].strip(), {})
+            seen = {}
+        elif line.startswith(':'):
+            chains.setdefault(line[1:].split()[0], [])
+        elif line.startswith('['):
+            counts, _, rule = line.partition(']')
+            pkts, bytes = counts[1:].split(':')
+            words = rule.split()
+            if len(words) < 2 or words[0] != '-A':
+                continue
+            chain = chains.setdefault(words[1], [])
+            target = ''
+            for option in ('-j', '-g'):
+                if option in words[2:-1]:
+                    target = words[words.index(option, 2) + 1]
+            key = ' '.join(words[2:])
+            seen[(words[1], key)] = seen.get((words[1], key), 0) + 1
+            if seen[(words[1], key)] > 1:
+                key = key + ' #' + str(seen[(words[1], key)])
+            names = ()
+            comment = COMMENT_SAVE_RE.search(rule)
+            if comment is not None:
+                names = (comment.group(1) or comment.group(2),)
+            chain.append((len(chain) + 1, int(pkts), int(bytes), target, key, names))
+
+    return index
+
+def parseNft(ruleset):
+    """ Parse the JSON document from nft -j list ruleset into an index like parseSave. Tables are named
+        '<family> <name>', the target is the verdict in upper case or the chain jumped to. Rules are named by
+        their handle as '#<handle>' and their comment if any, the rule key is the comment or the rule's
+        expressions without the counter. Rules without a counter are left out but still numbered.
+    """
+    items = ruleset.get('nftables', [])
+    named = {} #Named counter objects
+    for item in items:
+        counter = item.get('counter')
+        if isinstance(counter, dict):
+            named[(counter['family'], counter['table'], counter['name'])] = (counter['packets'], counter['bytes'])
+
+    index = {}
+    positions = {}
+    seen = {}
+    for item in items:
+        if 'table' in item:
+            index.setdefault(item['table']['family'] + ' ' + item['table']['name'], {})
+        elif 'chain' in item:
+            chain = item['chain']
+            index.setdefault(chain['family'] + ' ' + chain['table'], {}).setdefault(chain['name'], [])
+        elif 'rule' in item:
+            rule = item['rule']
+            chainKey = (rule['family'] + ' ' + rule['table'], rule['chain'])
+            chain = index.setdefault(chainKey[0], {}).setdefault(chainKey[1], [])
+            positions[chainKey] = positions.get(chainKey, 0) + 1
+            counter = None
+            target = ''
+            for expr in rule.get('expr', []):
+                if 'counter' in expr:
+                    counter = expr['counter']
+                    if not isinstance(counter, dict):
+                        counter = dict(zip(('packets', 'bytes'), named.get((rule['family'], rule['table'], counter), (0, 0))))
+                for verdict in NFT_VERDICTS:
+                    if verdict in expr:
+                        target = verdict.upper()
+                        if isinstance(expr[verdict], dict) and 'target' in expr[verdict]:
+                            target = expr[verdict]['target']
+            if counter is None:
+                continue
+            names = ('#' + str(rule.get('handle')),)
+            if rule.get('comment'):
+                names = names + (rule['comment'],)
+                key = rule['comment']
+            else:
+                key = json.dumps([expr for expr in rule.get('expr', []) if 'counter' not in expr], sort_keys=True)
+            seen[chainKey + (key,)] = seen.get(chainKey + (key,), 0) + 1
+            if seen[chainKey + (key,)] > 1:
+                key = key + ' #' + str(seen[chainKey + (key,)])
+            chain.append((positions[chainKey], counter['packets'], counter['bytes'], target, key, names))
+
+    return index
+
+def readIptablesSave(tables):
+    "Counter source reading every table from one iptables-save."
+    outpipe = os.popen(IPTABLES_SAVE + ' -c', 'r')
+    try:
+        return parseSave(outpipe)
+    finally:
+        outpipe.close()
+
+def readIptablesList(tables):
+    "Counter source listing every chain in each of the tables with iptables -L, without zeroing them."
+    index = {}
+    for table in tables:
+        outpipe = os.popen(IPTABLES + ' -L -x -n -v --line-numbers -t ' + table, 'r')
+        try:
+            index[table] = parseList(outpipe)
+        finally:
+            outpipe.close()
+    return index
+
+def readNft(tables):
+    "Counter source reading the whole nftables ruleset as JSON, raises IOError if it can't be read."
+    command = NFT + ' -j list ruleset'
+    outpipe = os.popen(command, 'r')
+    try:
+        out = outpipe.read()
+    finally:
+        status = outpipe.close()
+    if status:
+        raise IOError("'%s' failed with exit status %d" % (command, status >> 8))
+    if not out.strip():
+        raise IOError("'%s' returned nothing" % command)
+    try:
+        return parseNft(json.loads(out))
+    except ValueError, e:
+        raise IOError("'%s' returned invalid JSON, %s" % (command, e))
+
+#Functions taking the tables selected and returning an index of their counters like parseSave
+COUNTER_SOURCES={'iptables-save': readIptablesSave, 'iptables': readIptablesList, 'nft': readNft}
+
+def findTable(index, table):
+    """ Returns the name of table in the index. If it isn't there but is the name of exactly one nftables table
+        in any family, like filter for 'inet filter', that is used. Otherwise returns table.
+    """
+    if table in index:
+        return table
+    matches = [name for name in index if name.split(' ', 1)[-1] == table]
+    if len(matches) == 1:
+        return matches[0]
+    return table
+
+def parseSelection(selection, table, rules):
+    """ Parse a selection like [table/]chain[:rule,rule] returning a tuple of (table, chain, rules), the table
+        and rules default to those given. Rules are line numbers, nftables handles like #12 or comments.
+    """
+    selection, _, ruleList = selection.partition(':')
+    if '/' in selection:
+        table, chain = selection.split('/', 1)
+    else:
+        chain = selection
+    if ruleList:
+        rules = []
+        for rule in ruleList.split(','):
+            if rule.isdigit():
+                rules.append(int(rule))
+            else:
+                rules.append(rule)
+    if rules != None:
+        rules = set(rules)
+    return table, chain, rules
+
+def snapshot(options):
+    """ Take one snapshot of the counters from the counter source and check each selected chain from it.
+        Returns a list of ('table/chain', exit code, message, perfdata).
+    """
+    selections = [parseSelection(selection, options.table, options.rules) for selection in options.selections]
+    if options.collected:
+        index = readCollected(options.latest, options.maxAge)
+    else:
+        index = COUNTER_SOURCES[options.source](sorted(set([table for table, chain, rules in selections])))
+    selections = [(findTable(index, table), chain, rules) for table, chain, rules in selections]
+    previous = {}
+    if options.rate:
+        samples = {}
+        for table, chain, rules in selections:
+            if chain in index.get(table, {}):
+                samples[table + '/' + chain] = index[table][chain]
+        try:
+            previous, now = saveSamples(options.stateFile, samples)
+        except (IOError, OSError), e:
+            return [(table + '/' + chain, 3, ' Could not save the sample to %s, %s' % (options.stateFile, e), '')
+                for table, chain, rules in selections]
+
+    checks = []
+    for table, chain, rules in selections:
+        chainKey = table + '/' + chain
+        if chain not in index.get(table, {}):
+            checks.append((chainKey, 3, ' Chain ' + chainKey + ' not found', ''))
+            continue
+        if options.rate:
+            results = rateResults(index[table][chain], previous[chainKey], now, rules)
+            if results is None:
+                checks.append((chainKey, 0, ' ' + chainKey + ' first sample saved, rates will be available from the next check', ''))
+                continue
+        else:
+            results = countResults(index[table][chain], rules)
+        if options.commandFile is None:
+            prefix = chainKey + ' '
+        else:
+            prefix = ''
+        (exit, mesg, perf) = buildOutput(results, options, prefix)
+        checks.append((chainKey, exit, mesg, perf))
+
+    return checks
+
+def writeCommands(path, host, serviceFormat, checks):
+    """ Write a PROCESS_SERVICE_CHECK_RESULT command to the nagios command file for each check.
+        Each command is a single write so they aren't interleaved with other writers.
+    """
+    now = int(time.time())
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    try:
+        for chainKey, exit, mesg, perf in checks:
+            service = serviceFormat % {'table': chainKey.split('/')[0], 'chain': chainKey.split('/', 1)[1]}
+            os.write(fd, '[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s%s|%s\n' % (now, host, service, exit, STATES[exit], mesg, perf.strip()))
+    finally:
+        os.close(fd)
+
+def ruleName(counter):
+    "Returns the graphite path component for a rule, its comment, nftables handle or line number."
+    for name in counter[5]:
+        if not name.startswith('#'):
+            return NAME_RE.sub('_', name)
+    if counter[5]:
+        return 'handle' + counter[5][0][1:]
+    return 'rule' + str(counter[0])
+
+def metricLines(prefix, chainKey, rates, now):
+    "Returns the rates of a chain as carbon plaintext protocol lines."
+    table, chain = chainKey.split('/', 1)
+    path = '.'.join((prefix, NAME_RE.sub('_', table), NAME_RE.sub('_', chain))) + '.'
+    suffix = ' %d' % now
+    lines = []
+    for counter in rates:
+        name = path + ruleName(counter)
+        lines.append(name + '.packets ' + str(counter[1]) + suffix)
+        lines.append(name + '.bytes ' + str(counter[2]) + suffix)
+    return lines
+
+def sendCarbon(address, sock, lines):
+    """ Send the lines to the carbon plaintext port at address, connecting first if sock is None. Returns the
+        socket, or None if the lines couldn't be sent in which case they are dropped and the next call reconnects.
+    """
+    try:
+        if sock is None:
+            sock = socket.create_connection(address, CARBON_TIMEOUT)
+        sock.sendall('\n'.join(lines) + '\n')
+        return sock
+    except socket.error, e:
+        sys.stderr.write('Dropped %d metrics, could not send them to carbon at %s:%d, %s\n' % ((len(lines),) + address + (e,)))
+        if sock is not None:
+            sock.close()
+        return None
+
+def spoolLines(path, lines):
+    "Append the lines to a nag2carbon.py spool file in a single write so concurrent writers don't interleave."
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(fd, '\n'.join(lines) + '\n')
+    finally:
+        os.close(fd)
+
+def writeLatest(path, now, interval, chains):
+    "Atomically replace the latest file with the rates of each 'table/chain' for --collected."
+    writeJSON(path, {'time': now, 'interval': interval, 'chains': chains})
+
+def readCollected(path, maxAge):
+    """ Read the rates written by --collect into an index like parseSave. Raises IOError if the file can't be read
+        and ValueError if it is older than maxAge, by default 3 of the collector's intervals.
+    """
+    with open(path, 'r') as latestIn:
+        latest = json.load(latestIn)
+    try:
+        if maxAge is None:
+            maxAge = 3 * latest['interval']
+        age = time.time() - latest['time']
+        index = {}
+        for chainKey, rates in latest['chains'].items():
+            table, chain = chainKey.split('/', 1)
+            index.setdefault(table, {})[chain] = [tuple(counter[:5]) + (tuple(counter[5]),) for counter in rates]
+    except (KeyError, TypeError, AttributeError, IndexError, ValueError):
+        raise ValueError('%s was not written by --collect' % path)
+    if age > maxAge:
+        raise ValueError('the collected counters in %s were last written %d seconds ago, is --collect running?' % (path, age))
+    return index
+
+def collect(options):
+    """ Sample the selected chains from the counter source every options.interval seconds until killed, sending the
+        per second rates since the previous sample to carbon and/or the spool and writing them to the latest file.
+    """
+    selections = [parseSelection(selection, options.table, options.rules) for selection in options.selections]
+    tables = sorted(set([table for table, chain, rules in selections]))
+    source = COUNTER_SOURCES[options.source]
+    previous = {} #The last sample of each chain
+    sock = None
+    nextSample = time.time()
+    while True:
+        #A failure is logged and the next interval tried, a transient error shouldn't stop the collector
+        try:
+            index = source(tables)
+        except (IOError, OSError, ValueError), e:
+            sys.stderr.write('Skipped a sample, could not read the counters, %s\n' % e)
+            index = {}
+        now = time.time()
+        lines = []
+        chains = {}
+        for table, chain, rules in selections:
+            table = findTable(index, table)
+            chainKey = table + '/' + chain
+            counters = index.get(table, {}).get(chain)
+            if counters is None:
+                continue
+            rates = rateCounters(counters, previous.get(chainKey), now)
+            previous[chainKey] = sample(counters, now)
+            if rates is None:
+                continue
+            chains[chainKey] = selected(rates, rules)
+            lines.extend(metricLines(options.metricPrefix, chainKey, chains[chainKey], now))
+
+        if chains:
+            try:
+                writeLatest(options.latest, now, options.interval, chains)
+            except (IOError, OSError), e:
+                sys.stderr.write('Could not write the latest rates to %s, %s\n' % (options.latest, e))
+        if lines:
+            if options.carbon is not None:
+                sock = sendCarbon(options.carbon, sock, lines)
+            if options.spool is not None:
+                try:
+                    spoolLines(options.spool, lines)
+                except (IOError, OSError), e:
+                    sys.stderr.write('Dropped %d metrics, could not write them to %s, %s\n' % (len(lines), options.spool, e))
+
+        #Keep to the interval, skipping samples rather than bunching them up if one took too long
+        nextSample += options.interval
+        now = time.time()
+        if nextSample < now:
+            nextSample = now + options.interval - (now - nextSample) % options.interval
+        time.sleep(nextSample - now)
+
 if __name__ == "__main__":
     sys.exit(main())
@@ -6,57 +6,1126 @@
     The command expects the hostname, service name and performance data to be passed in.
     Optionally a hostgroup can be included, if so it is checked against a list of hostgroups
     processing is done for and if it isn't in that list it is skipped.
+
+    With --objects-cache the hostgroups of every host are read from the nagios objects.cache so the
+    hostgroup argument isn't needed. The file is parsed into an index of host to hostgroups which is saved to
+    --index-cache, later runs load the saved index and only reparse when the objects.cache changes. The
+    default is in /var/lib/nagios, which should belong to the nagios user, and an index owned by another user
+    is ignored.
+    --hostgroup replaces the HOSTGROUPS list, --exclude-hostgroup skips hosts in a hostgroup and --host,
+    --exclude-host, --service and --exclude-service filter by regex on the host name and service description.
+    The HOSTGROUPS list only applies when neither --hostgroup nor --exclude-hostgroup is given, with
+    --all-hostgroups every hostgroup is processed. Hosts whose hostgroups aren't known are not filtered by
+    hostgroup.
+
+    Rather than connecting to carbon for every event the data can be spooled, either appended to a file
+    with --spool or sent to a unix datagram socket with --spool-socket. A long running relay started with
+    --relay and the same spool option reads the spool and streams the data to carbon in batches over a
+    single connection which is reopened with backoff if it fails.
+
+    To avoid running a command per check at all nagios can write perfdata to host_perfdata_file and
+    service_perfdata_file, then periodically move them aside with process_perfdata_file_command. Running
+    with --perfdata-file sends one of these files to carbon in large batches. Both the default nagios
+    templates and the KEY::value format used by pnp4nagios are understood, for example
+        [SERVICEPERFDATA]\t$TIMET$\t$HOSTNAME$\t$SERVICEDESC$\t$SERVICEEXECUTIONTIME$\t$SERVICELATENCY$\t$SERVICEOUTPUT$\t$SERVICEPERFDATA$
+        DATATYPE::HOSTPERFDATA\tTIMET::$TIMET$\tHOSTNAME::$HOSTNAME$\tHOSTPERFDATA::$HOSTPERFDATA$
+    Host perfdata is sent with a service name of 'host'. If the KEY::value format includes HOSTGROUPNAME
+    it is filtered in the same way as the hostgroup argument.
+
+    With --pickle data is sent to carbon using the pickle protocol, by default on port 2004, in batches
+    of up to --batch-size metrics. This is much cheaper for carbon to ingest than the plaintext protocol.
+    Metrics with non numeric values are dropped as carbon can't store them.
+
+    Perfdata is parsed following the nagios plugin guidelines, 'label'=value[UOM];[warn];[crit];[min];[max]
+    with labels optionally quoted so they can contain spaces. Values are normalized to base units, times to
+    seconds and KB, MB, GB and TB to bytes. With --thresholds the warn, crit, min and max fields are also
+    sent as <label>_warn, <label>_crit, <label>_min and <label>_max, thresholds which are ranges are skipped.
+    The hostname, service and label are sanitized to be a single graphite path component, runs of
+    characters other than letters, numbers, _ and - are replaced by _.
+
+    To send to several carbon-cache instances without a relay in between list them with --destinations,
+    in the same host:port[:instance] format as DESTINATIONS in carbon.conf. Each metric is routed with the
+    consistent hash ring carbon-relay uses with RELAY_METHOD = consistent-hashing, so it reaches the instance
+    which owns its whisper file. Every destination has its own batching connection.
+
+    The relay, replay and perfdata file modes send their own metrics to carbon under --stats-prefix, by
+    default nag2carbon.<hostname>. These are the lines parsed, parse failures, lines sent, bytes sent,
+    connect failures, lines buffered, number of batches and their average and max send time in seconds, and
+    the bytes waiting in the buffer. Counts are for the period since the last flush, every --stats-interval
+    seconds in the relay and at the end of the other modes.
+
+    With --buffer <dir> data which can't be sent because carbon is unreachable is appended to segment files
+    in the directory rather than being lost. The relay replays the buffer once carbon is reachable again at up
+    to --replay-rate metrics per second, the original timestamps are kept. The buffer can also be replayed by
+    running with --replay, for example from cron when only the per event mode is used. An index file records
+    how far the replay has got so a restart resumes from there, a segment is removed once fully replayed.
+
+    Connecting and sending to carbon time out after --timeout seconds, so a carbon host which is down or has
+    stopped reading counts as unreachable rather than blocking until nagios kills the perfdata command.
 """
 
+import bisect
+import cPickle
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import re
+import signal
+import socket
+import string
+import struct
 import sys
 import time
-from socket import socket
+from optparse import OptionParser
 
 CARBON_SERVER = '127.0.0.1'
 CARBON_PORT = 2003
+CARBON_PICKLE_PORT = 2004
+CARBON_TIMEOUT = 5 #Seconds to wait connecting to or sending to carbon, nagios kills perfdata commands quickly
+DESTINATIONS = [] #(server, port, instance) tuples, if set used rather than CARBON_SERVER and CARBON_PORT
+REPLICA_COUNT = 100 #Positions for each destination on the hash ring, the same as carbon-relay
+ROUTE_CACHE_SIZE = 100000 #Max metric paths whose destination is cached
 
-#Only process performance data for these host groups
+#Only process performance data for these host groups, if empty all are processed
 HOSTGROUPS = ['sql', 'windows']
+INDEX_CACHE = '/var/lib/nagios/nag2carbon.index' #Hostgroup index saved from --objects-cache
+INDEX_CHECK_INTERVAL = 1.0 #Min seconds between checks of the objects.cache mtime
+
+#Relay settings
+BATCH_SIZE = 500 #Max metrics sent to carbon in one write
+BULK_BATCH_SIZE = 5000 #Max metrics per write when sending a perfdata file
+FLUSH_INTERVAL = 1.0 #Max seconds data waits in the relay before being sent
+MAX_BACKOFF = 60 #Max seconds between carbon reconnect attempts
+SPOOL_GRACE = 0.1 #Seconds to let writers finish with a spool file after it is moved aside
+REPLAY_RATE = 1000 #Default max metrics per second replayed from the buffer
+STATS_PREFIX = 'nag2carbon.%s' #Formatted with the hostname
+STATS_INTERVAL = 60 #Seconds between sending the relays own metrics
+
+#Perfdata parsing
+UNIT_CHARS = string.ascii_letters + '%'
+UNIT_SET = frozenset(UNIT_CHARS)
+#Units which need scaling to the base unit as (multiplier, divisor), sub-units are divided by an integer
+#rather than multiplied by an inexact fraction so 12.3ms becomes 0.0123 and not 0.012300000000000002
+UNIT_SCALES = {'ms': (1, 1000), 'us': (1, 1000000), 'KB': (1024, 1), 'MB': (1024 ** 2, 1), 'GB': (1024 ** 3, 1),
+    'TB': (1024 ** 4, 1)}
+THRESHOLD_NAMES = ('warn', 'crit', 'min', 'max')
+NAME_RE = re.compile(r'[^\w-]+')
+NAME_CACHE_SIZE = 100000 #Max sanitized names cached
 
 def main(argv=None):
     if argv is None:
         argv = sys.argv
-    if len(argv) < 4:
+    (options, args) = parseArgs(argv)
+    if options.relay:
+        return relay(options)
+    if options.replay:
+        return replay(options)
+    if options.perfdata_file is not None:
+        return send_perfdata_file(options)
+
+    if len(args) < 4:
         print "Usage: " + argv[0] + " <hostname> <service name> <performance data> [Host group]"
         return 0
 
-    hostname = argv[1].replace('.', '_')
-    service = argv[2].replace(' ', '_')
-    pdata = argv[3]
+    #Skip if the host or service is filtered out
+    hostgroup = None
+    if len(args) == 5:
+        hostgroup = args[4]
+    if not make_filter(options).included(args[1], args[2], hostgroup):
+        print 'Host %s service %s is not one for which performance data is processed, skipping.' % \
+            (args[1], args[2])
+        return 0
+
+    lines, failures = perfdata_lines(args[1], args[2], args[3], int(time.time()), options.thresholds)
+    if failures:
+        print 'Skipped %d metrics from the performance data which could not be parsed' % failures
+
+    if options.spool is not None:
+        return spool_file(options.spool, lines)
+    if options.spool_socket is not None:
+        return spool_socket(options.spool_socket, lines)
+
+    #Setup the connection and send, giving up rather than retrying as nagios is waiting
+    client = carbon_client(options, options.batch_size or BATCH_SIZE)
+    try:
+        if options.buffer is not None:
+            if deliver(client, DiskBuffer(options.buffer), lines):
+                print "Couldn't connect to carbon server, buffered the data in %s" % options.buffer
+        elif client.connect_once():
+            try:
+                client.send(lines, retry=False)
+            except socket.error, e:
+                print "Error sending to carbon server, %s" % e
+                return 1
+        else:
+            print "Couldn't connect to carbon server"
+            return 1
+    finally:
+        client.close()
+
+
+def parseArgs(argv):
+    "Parses the arguments"
+    usage = "usage: %prog [options] <hostname> <service name> <performance data> [Host group]\n" + \
+        "       %prog --relay --spool <file> | --spool-socket <socket>"
+    parser = OptionParser(usage=usage)
+    parser.disable_interspersed_args() #Perfdata can look like options
+    parser.add_option('--server', dest='server', default=CARBON_SERVER, help='Carbon server. [default: %default]')
+    parser.add_option('--port', dest='port', type='int',
+        help='Carbon port. [default: %d or %d with --pickle]' % (CARBON_PORT, CARBON_PICKLE_PORT))
+    parser.add_option('--destinations', dest='destinations',
+        help='Comma separated carbon destinations, host:port[:instance], to route metrics to by consistent hash.' + \
+            ' Overrides --server and --port.')
+    parser.add_option('--pickle', dest='pickle', action='store_true', default=False,
+        help='Send to carbon using the pickle protocol.')
+    parser.add_option('--timeout', dest='timeout', type='float', default=CARBON_TIMEOUT,
+        help='Seconds to wait connecting to or sending to carbon. [default: %default]')
+    parser.add_option('--batch-size', dest='batch_size', type='int',
+        help='Max metrics sent in one write. [default: %d or %d with --perfdata-file]' % \
+            (BATCH_SIZE, BULK_BATCH_SIZE))
+    parser.add_option('--objects-cache', dest='objects_cache',
+        help='Read host hostgroups from this nagios objects.cache.')
+    parser.add_option('--index-cache', dest='index_cache', default=INDEX_CACHE,
+        help='Where the hostgroup index from the objects.cache is saved. [default: %default]')
+    parser.add_option('--hostgroup', dest='hostgroups', action='append', metavar='HOSTGROUP',
+        help='Only process hosts in this hostgroup, can be repeated. [default: %s unless --exclude-hostgroup or ' \
+            '--all-hostgroups is given]' % ', '.join(HOSTGROUPS))
+    parser.add_option('--all-hostgroups', dest='all_hostgroups', action='store_true', default=False,
+        help='Process hosts in any hostgroup rather than only the default HOSTGROUPS.')
+    parser.add_option('--exclude-hostgroup', dest='exclude_hostgroups', action='append', default=[],
+        metavar='HOSTGROUP', help='Skip hosts in this hostgroup, can be repeated.')
+    parser.add_option('--host', dest='host', metavar='REGEX', help='Only process hosts matching this regex.')
+    parser.add_option('--exclude-host', dest='exclude_host', metavar='REGEX', help='Skip hosts matching this regex.')
+    parser.add_option('--service', dest='service', metavar='REGEX',
+        help='Only process services matching this regex.')
+    parser.add_option('--exclude-service', dest='exclude_service', metavar='REGEX',
+        help='Skip services matching this regex.')
+    parser.add_option('--thresholds', dest='thresholds', action='store_true', default=False,
+        help='Also send the warn, crit, min and max perfdata fields.')
+    parser.add_option('--spool', dest='spool', help='Append the data to this spool file rather than sending it.')
+    parser.add_option('--spool-socket', dest='spool_socket',
+        help='Send the data to the relay listening on this unix datagram socket rather than to carbon.')
+    parser.add_option('--relay', dest='relay', action='store_true', default=False,
+        help='Run as a relay sending data from the spool to carbon.')
+    parser.add_option('--buffer', dest='buffer', metavar='DIR',
+        help='Buffer data in this directory when carbon is unreachable.')
+    parser.add_option('--replay', dest='replay', action='store_true', default=False,
+        help='Replay the data in the buffer to carbon then exit.')
+    parser.add_option('--replay-rate', dest='replay_rate', type='float', default=REPLAY_RATE,
+        help='Max metrics per second sent when replaying the buffer. [default: %default]')
+    parser.add_option('--stats-prefix', dest='stats_prefix',
+        help='Prefix for metrics about nag2carbon itself. [default: %s]' % (STATS_PREFIX % '<hostname>'))
+    parser.add_option('--stats-interval', dest='stats_interval', type='float', default=STATS_INTERVAL,
+        help='Seconds between sending metrics about the relay, 0 to disable them. [default: %default]')
+    parser.add_option('--perfdata-file', dest='perfdata_file',
+        help='Send the contents of this nagios host or service perfdata file to carbon.')
+    parser.add_option('--remove', dest='remove', action='store_true', default=False,
+        help='Remove the perfdata file once it has been sent.')
+    #The program name is left in args to keep the positions of the arguments the same as argv
+    (options, args) = parser.parse_args(argv[1:])
+    args.insert(0, argv[0])
+
+    if options.port is None:
+        if options.pickle:
+            options.port = CARBON_PICKLE_PORT
+        else:
+            options.port = CARBON_PORT
+    if options.hostgroups is None:
+        if options.exclude_hostgroups or options.all_hostgroups:
+            options.hostgroups = []
+        else:
+            options.hostgroups = HOSTGROUPS
+    if options.stats_prefix is None:
+        options.stats_prefix = STATS_PREFIX % metric_name(socket.gethostname())
+    for regex in ('host', 'exclude_host', 'service', 'exclude_service'):
+        if getattr(options, regex) is not None:
+            try:
+                setattr(options, regex, re.compile(getattr(options, regex)))
+            except re.error, e:
+                parser.error('Invalid --%s regex, %s' % (regex.replace('_', '-'), e))
+    if options.destinations is not None:
+        try:
+            options.destinations = parse_destinations(options.destinations)
+        except ValueError, e:
+            parser.error(str(e))
+    else:
+        options.destinations = DESTINATIONS
+    if options.spool is not None and options.spool_socket is not None:
+        parser.error('--spool and --spool-socket are mutually exclusive')
+    if options.relay and options.spool is None and options.spool_socket is None:
+        parser.error('--relay requires --spool or --spool-socket')
+    if options.replay and options.buffer is None:
+        parser.error('--replay requires --buffer')
+
+    return options, args
+
+def parse_destinations(destinations):
+    "Parse a comma separated list of host:port[:instance] into a list of (server, port, instance)."
+    parsed = []
+    keys = set()
+    for destination in destinations.split(','):
+        fields = destination.strip().split(':')
+        if len(fields) not in (2, 3) or not fields[1].isdigit():
+            raise ValueError('Invalid destination %s, should be host:port[:instance]' % destination.strip())
+        server, port, instance = fields[0], int(fields[1]), None
+        if len(fields) == 3:
+            instance = fields[2]
+        if (server, instance) in keys: #carbon-relay identifies destinations by server and instance
+            raise ValueError('Destinations on the same server need distinct instance names')
+        keys.add((server, instance))
+        parsed.append((server, port, instance))
+    return parsed
+
+def make_filter(options):
+    "Returns the HostFilter configured by the options."
+    index = None
+    if options.objects_cache is not None:
+        index = HostgroupIndex(options.objects_cache, options.index_cache)
+    return HostFilter(index, options.hostgroups, options.exclude_hostgroups, options.host, options.exclude_host,
+        options.service, options.exclude_service)
+
+def parse_objects_cache(path):
+    "Parse a nagios objects.cache returning a dictionary of host name to a tuple of its hostgroups."
+    hostgroups = {}
+    definition = None
+    fields = {}
+    with open(path, 'r') as objects:
+        for line in objects:
+            line = line.strip()
+            if line.startswith('define '):
+                definition = line[7:].rstrip('{ \t')
+                fields = {}
+            elif line == '}':
+                if definition == 'hostgroup' and 'hostgroup_name' in fields:
+                    group = intern(fields['hostgroup_name'])
+                    for host in fields.get('members', '').split(','):
+                        if host.strip():
+                            hostgroups.setdefault(host.strip(), set()).add(group)
+                elif definition == 'host' and 'host_name' in fields:
+                    groups = hostgroups.setdefault(fields['host_name'], set())
+                    for group in fields.get('hostgroups', '').split(','):
+                        if group.strip():
+                            groups.add(intern(group.strip()))
+                definition = None
+            elif definition in ('host', 'hostgroup'):
+                key, _, value = line.partition('\t')
+                fields[key] = value.strip()
+
+    return dict((host, tuple(sorted(groups))) for host, groups in hostgroups.iteritems())
+
+
+class HostgroupIndex(object):
+    """ The hostgroups of each host from the nagios objects.cache.
+        The parsed index is saved to index_cache as JSON along with the mtime and size of the objects.cache so
+        other runs can load it rather than reparsing. A saved index not owned by this user is ignored. The
+        objects.cache is checked for changes at most every INDEX_CHECK_INTERVAL seconds and reloaded if it has.
+    """
+    def __init__(self, objects_cache, index_cache):
+        self.objects_cache = objects_cache
+        self.index_cache = index_cache
+        self.hosts = {}
+        self.version = None
+        self.checked = 0
+
+    def hostgroups(self, host):
+        "Returns a tuple of the hostgroups of host or None if it isn't known."
+        now = time.time()
+        if now - self.checked >= INDEX_CHECK_INTERVAL:
+            self.checked = now
+            self.refresh()
+        return self.hosts.get(host)
 
-    #Skip if the specified hostgroup is not in the list to process.
-    if len(argv) == 5:
-        hostgroup = argv[4]
-        if hostgroup not in HOSTGROUPS:
-            print 'Hostgroup %s not in the list of hostgroups for which performance data' % hostgroup + \
-                ' is processesed, skipping.'
-            return 0
+    def refresh(self):
+        try:
+            stat = os.stat(self.objects_cache)
+        except OSError, e:
+            print "Couldn't read the objects cache %s, %s" % (self.objects_cache, e)
+            return
+        version = (os.path.abspath(self.objects_cache), stat.st_mtime, stat.st_size)
+        if version == self.version:
+            return
+        try:
+            with open(self.index_cache, 'r') as index_file:
+                if os.fstat(index_file.fileno()).st_uid == os.getuid():
+                    saved_version, hosts = json.load(index_file)
+                    if saved_version == list(version):
+                        self.hosts = dict((host.encode('utf-8'), tuple(intern(group.encode('utf-8')) for group in groups))
+                            for host, groups in hosts.iteritems())
+                        self.version = version
+                        return
+        except (IOError, ValueError, TypeError, AttributeError):
+            pass
 
-    #Parse the perfdata
+        try:
+            self.hosts = parse_objects_cache(self.objects_cache)
+        except IOError, e:
+            print "Couldn't read the objects cache %s, %s" % (self.objects_cache, e)
+            return
+        self.version = version
+        try: #Written to a temporary file then renamed so readers never see part of it
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.index_cache)))
+            os.fchmod(fd, 0644)
+            with os.fdopen(fd, 'w') as index_file:
+                json.dump((version, self.hosts), index_file)
+            os.rename(tmp_path, self.index_cache)
+        except (IOError, OSError), e:
+            print "Couldn't save the hostgroup index to %s, %s" % (self.index_cache, e)
+
+
+class HostFilter(object):
+    """ Decides which hosts and services perfdata is processed for. Hostgroups come from the index, if any,
+        and from the hostgroup passed in with the perfdata. Hosts whose hostgroups aren't known are only
+        filtered by the regexes.
+    """
+    def __init__(self, index=None, hostgroups=(), exclude_hostgroups=(), host=None, exclude_host=None,
+            service=None, exclude_service=None):
+        self.index = index
+        self.hostgroups = frozenset(hostgroups)
+        self.exclude_hostgroups = frozenset(exclude_hostgroups)
+        self.host = host
+        self.exclude_host = exclude_host
+        self.service = service
+        self.exclude_service = exclude_service
+
+    def included(self, hostname, service, hostgroup=None):
+        "True if perfdata for the host and service should be processed."
+        groups = None
+        if self.index is not None:
+            groups = self.index.hostgroups(hostname)
+        if hostgroup is not None:
+            groups = (groups or ()) + (hostgroup,)
+        if groups is not None:
+            if self.exclude_hostgroups.intersection(groups):
+                return False
+            if self.hostgroups and not self.hostgroups.intersection(groups):
+                return False
+        if self.host is not None and self.host.search(hostname) is None:
+            return False
+        if self.exclude_host is not None and self.exclude_host.search(hostname) is not None:
+            return False
+        if self.service is not None and self.service.search(service) is None:
+            return False
+        if self.exclude_service is not None and self.exclude_service.search(service) is not None:
+            return False
+        return True
+
+_names = {}
+def metric_name(name):
+    "Sanitize name to be a single graphite path component, the results are cached."
+    try:
+        return _names[name]
+    except KeyError:
+        if len(_names) >= NAME_CACHE_SIZE:
+            _names.clear()
+        sanitized = _names[name] = NAME_RE.sub('_', name)
+        return sanitized
+
+def scale_value(number, multiplier, divisor):
+    "Returns number scaled to the base unit as a string, an integer if it is whole and exact digits otherwise."
+    scaled = number * multiplier / divisor
+    if scaled % 1 == 0:
+        return '%d' % scaled
+    return repr(scaled)
+
+def scale_threshold(field, multiplier, divisor):
+    "Scale a threshold field to the base unit leaving it empty if it isn't a plain number."
+    try:
+        return scale_value(float(field), multiplier, divisor)
+    except ValueError:
+        return ''
+
+_units = {}
+def unit_scale(unit):
+    "Returns the (multiplier, divisor) for a unit, falling back to the upper case unit, or None. Cached."
+    if len(_units) >= NAME_CACHE_SIZE:
+        _units.clear()
+    scale = _units[unit] = UNIT_SCALES.get(unit) or UNIT_SCALES.get(unit.upper())
+    return scale
+
+def perfdata_lines(hostname, service, pdata, now, thresholds=False):
+    """ Parse plugin perfdata in a single pass returning a tuple of (lines in the carbon plaintext format,
+        number of unparsable tokens). Values are normalized to base units. If thresholds is True the warn,
+        crit, min and max fields which are numbers are included.
+        This splits on whitespace rejoining quoted labels rather than using a regex as it is several times
+        faster, runs of whitespace in quoted labels become a single space.
+    """
+    prefix = '%s.%s.' % (metric_name(hostname), metric_name(service))
+    suffix = ' %d' % now
+    names = _names
+    units = _units
+    unit_set = UNIT_SET
     lines = []
-    now = int(time.time())
-    for perf in pdata.split(): #split all the data on whitespace
-        pname, pvalues = perf.split('=', 1) #name and values split on =
-        pvalue = pvalues.split(';')[0] #Only take the first value
-        lines.append("%s.%s.%s %s %d" % (hostname, service, pname, pvalue, now))
-
-    #Setup the socket
-    sock = socket()
-    try:
-        sock.connect( (CARBON_SERVER, CARBON_PORT) )
-    except:
-        print "Couldn't connect to carbon server"
+    append = lines.append #Bound once, this loop runs for every metric
+    failures = 0
+    tokens = iter(pdata.split())
+    for token in tokens:
+        if token[0] == "'":
+            while "'=" not in token:
+                token += ' ' + next(tokens, "'=")
+            label, sep, values = token.rpartition("'=")
+            label = label[1:].replace("''", "'")
+        else:
+            label, sep, values = token.partition('=')
+        value, _, fields = values.partition(';')
+        scale = None
+        if value and value[-1] in unit_set:
+            number = value.rstrip(UNIT_CHARS)
+            unit = value[len(number):]
+            value = number
+            try:
+                scale = units[unit]
+            except KeyError:
+                scale = unit_scale(unit)
+        try:
+            number = float(value)
+        except ValueError:
+            failures += 1
+            continue
+        if not label:
+            failures += 1
+            continue
+        if scale is not None:
+            number = number * scale[0] / scale[1] #scale_value inlined, this runs for every metric with a unit
+            if number % 1 == 0:
+                value = '%d' % number
+            else:
+                value = repr(number)
+            if thresholds and fields:
+                fields = ';'.join(scale_threshold(field, scale[0], scale[1]) for field in fields.split(';'))
+        name = prefix + (names.get(label) or metric_name(label))
+        append(name + ' ' + value + suffix)
+        if thresholds and fields:
+            for field_name, field in zip(THRESHOLD_NAMES, fields.split(';')):
+                try:
+                    float(field)
+                except ValueError: #Empty or a range
+                    continue
+                append(name + '_' + field_name + ' ' + field + suffix)
+
+    return lines, failures
+
+def spool_file(path, lines):
+    "Append the lines to the spool file in a single write so concurrent writers don't interleave."
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(fd, "\n".join(lines) + "\n")
+    finally:
+        os.close(fd)
+
+def spool_socket(path, lines):
+    "Send the lines as a single datagram to the relay."
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.settimeout(1) #Don't hold up nagios if the relay is backed up
+    try:
+        sock.sendto("\n".join(lines) + "\n", path)
+    except socket.error, e:
+        print "Couldn't send to the relay at %s: %s" % (path, e)
         return 1
+    finally:
+        sock.close()
+
+
+def parse_perfdata_file_line(line):
+    """ Parse a line from a nagios perfdata file returning a tuple of
+        (timestamp, hostname, service, perfdata, hostgroup or None) or None if it isn't perfdata.
+    """
+    fields = line.rstrip('\n').split('\t')
+    if '::' in fields[0]: #KEY::value format
+        values = dict(field.split('::', 1) for field in fields if '::' in field)
+        datatype = values.get('DATATYPE')
+        if datatype == 'SERVICEPERFDATA':
+            service, pdata = values.get('SERVICEDESC'), values.get('SERVICEPERFDATA')
+        elif datatype == 'HOSTPERFDATA':
+            service, pdata = 'host', values.get('HOSTPERFDATA')
+        else:
+            return None
+        if service is None or pdata is None or 'HOSTNAME' not in values or 'TIMET' not in values:
+            return None
+        return int(values['TIMET']), values['HOSTNAME'], service, pdata, values.get('HOSTGROUPNAME')
+
+    #The default templates
+    if fields[0] == '[SERVICEPERFDATA]' and len(fields) >= 8:
+        return int(fields[1]), fields[2], fields[3], fields[7], None
+    elif fields[0] == '[HOSTPERFDATA]' and len(fields) >= 6:
+        return int(fields[1]), fields[2], 'host', fields[5], None
+    return None
+
+def send_perfdata_file(options):
+    """ Send the perfdata in a nagios host or service perfdata file to carbon.
+        The file is streamed, lines that can't be parsed are counted and skipped.
+    """
+    batch_size = options.batch_size or BULK_BATCH_SIZE
+    client = carbon_client(options, batch_size)
+    buffer = None
+    if options.buffer is not None:
+        buffer = DiskBuffer(options.buffer)
+    host_filter = make_filter(options)
+    lines = []
+    skipped = 0
+    skipped_metrics = 0
+    linenum = 0
+    try:
+        with open(options.perfdata_file, 'r') as perfdata_file:
+            for linenum, line in enumerate(perfdata_file, 1):
+                try:
+                    parsed = parse_perfdata_file_line(line)
+                    if parsed is None:
+                        skipped += 1
+                        continue
+                    timestamp, hostname, service, pdata, hostgroup = parsed
+                    if not host_filter.included(hostname, service, hostgroup):
+                        continue
+                    parsed, failures = perfdata_lines(hostname, service, pdata, timestamp, options.thresholds)
+                    lines.extend(parsed)
+                    skipped_metrics += failures
+                except ValueError:
+                    skipped += 1
+                    continue
+                if len(lines) >= batch_size:
+                    deliver(client, buffer, lines)
+                    lines = []
+        deliver(client, buffer, lines)
+        stats.lines_parsed += linenum - skipped
+        stats.parse_failures += skipped + skipped_metrics
+        send_stats(options, client, buffer)
+    finally:
+        client.close()
+
+    if skipped:
+        print 'Skipped %d lines from %s which could not be parsed' % (skipped, options.perfdata_file)
+    if skipped_metrics:
+        print 'Skipped %d metrics from %s which could not be parsed' % (skipped_metrics, options.perfdata_file)
+    if options.remove:
+        os.remove(options.perfdata_file)
+    return 0
+
+
+def pickle_message(lines):
+    """ Convert plaintext protocol lines to a carbon pickle protocol message, a length prefixed pickled
+        list of (path, (timestamp, value)). Lines without a numeric value are dropped.
+    """
+    metrics = []
+    for line in lines:
+        try:
+            path, value, timestamp = line.split()
+            metrics.append((path, (int(timestamp), float(value))))
+        except ValueError:
+            continue
+    payload = cPickle.dumps(metrics, 2)
+    return struct.pack('!L', len(payload)) + payload
+
+
+def carbon_client(options, batch_size):
+    "Returns a CarbonRouter if destinations are configured otherwise a CarbonClient."
+    if options.destinations:
+        return CarbonRouter(options.destinations, batch_size, options.pickle, options.timeout)
+    return CarbonClient(options.server, options.port, batch_size, options.pickle, options.timeout)
+
+def deliver(client, buffer, lines):
+    """ Send the lines to carbon. If buffer is None this blocks until carbon can be reached otherwise
+        any lines which can't be sent are appended to the buffer. Returns the number of lines buffered.
+    """
+    if buffer is None:
+        client.send(lines)
+        return 0
+    buffered = 0
+    for destination, destination_lines in client.route(lines):
+        for start in range(0, len(destination_lines), destination.batch_size):
+            try:
+                destination.send(destination_lines[start:start + destination.batch_size], retry=False)
+            except socket.error:
+                buffer.append(destination_lines[start:])
+                buffered += len(destination_lines) - start
+                break
+    stats.lines_buffered += buffered
+    return buffered
 
-    #send the message, each line seperated by newlines and with a trailing newline
-    sock.sendall("\n".join(lines) + "\n")
+def send_stats(options, client, buffer):
+    "Send the metrics about nag2carbon itself if enabled."
+    if options.stats_interval:
+        deliver(client, buffer, stats.lines(options.stats_prefix, int(time.time()), buffer))
+
+
+class Stats(object):
+    """ Counters for the metrics nag2carbon sends about itself, kept as plain attributes so counting is cheap.
+        Counts are since the last time lines was called.
+    """
+    COUNTERS = ('lines_parsed', 'parse_failures', 'lines_sent', 'bytes_sent', 'connect_failures',
+        'lines_buffered', 'batches')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.batch_seconds = 0.0
+        self.batch_seconds_max = 0.0
+
+    def batch(self, lines, size, seconds):
+        "Count a batch of lines, size bytes, sent to carbon in seconds."
+        self.lines_sent += lines
+        self.bytes_sent += size
+        self.batches += 1
+        self.batch_seconds += seconds
+        if seconds > self.batch_seconds_max:
+            self.batch_seconds_max = seconds
+
+    def lines(self, prefix, now, buffer=None):
+        "Returns the stats as carbon plaintext protocol lines and resets them."
+        values = [(name, getattr(self, name)) for name in self.COUNTERS]
+        if self.batches:
+            values.append(('batch_latency_avg', self.batch_seconds / self.batches))
+        values.append(('batch_latency_max', self.batch_seconds_max))
+        if buffer is not None:
+            values.append(('buffer_bytes', buffer.depth()))
+        self.reset()
+        return ['%s.%s %s %d' % (prefix, name, value, now) for name, value in values]
+
+stats = Stats()
+
+
+
+class CarbonClient(object):
+    """ A persistent connection to carbon using either the plaintext or pickle protocol.
+        After a failed connection attempt no other is made for a backoff period which doubles with each
+        failure up to MAX_BACKOFF seconds. Connecting and sending each time out after timeout seconds so an
+        unreachable or stalled carbon is treated as a failure rather than blocking.
+    """
+    def __init__(self, server, port, batch_size=BATCH_SIZE, pickle=False, timeout=CARBON_TIMEOUT):
+        self.address = (server, port)
+        self.batch_size = batch_size
+        self.pickle = pickle
+        self.timeout = timeout
+        self.sock = None
+        self.backoff = 1
+        self.retry_at = 0
+        self.error = None
+
+    def connect_once(self):
+        "Try to connect unless in a backoff period, returns True if connected."
+        if self.sock is not None:
+            return True
+        if time.time() < self.retry_at:
+            return False
+        sock = socket.socket()
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except socket.error, e:
+            sock.close()
+            self.error = e
+            stats.connect_failures += 1
+            self.retry_at = time.time() + self.backoff
+            self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+            return False
+        self.sock = sock
+        self.backoff = 1
+        self.retry_at = 0
+        return True
+
+    def connect(self):
+        "Connect, retrying until successful."
+        while not self.connect_once():
+            wait = max(self.retry_at - time.time(), 0)
+            print "Couldn't connect to carbon server %s:%d, %s. Retrying in %ds" % \
+                (self.address + (self.error, wait))
+            time.sleep(wait)
+
+    def send(self, lines, retry=True):
+        """ Send the lines to carbon in batches of batch_size.
+            If retry is False socket.error is raised when carbon can't be reached rather than reconnecting.
+        """
+        for start in range(0, len(lines), self.batch_size):
+            batch = lines[start:start + self.batch_size]
+            if self.pickle:
+                data = pickle_message(batch)
+            else:
+                data = "\n".join(batch) + "\n"
+            while True:
+                if retry:
+                    self.connect()
+                elif not self.connect_once():
+                    raise self.error or socket.error('Waiting to reconnect')
+                try:
+                    start_time = time.time()
+                    self.sock.sendall(data)
+                    stats.batch(len(batch), len(data), time.time() - start_time)
+                    break
+                except socket.error, e:
+                    self.close()
+                    if not retry:
+                        raise
+                    print "Error sending to carbon, %s. Reconnecting" % e
+
+    def route(self, lines):
+        "Returns a list of (client, lines) for each destination, there is only this one."
+        return [(self, lines)]
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class ConsistentHashRing(object):
+    """ The consistent hash ring carbon-relay uses to pick the carbon-cache for a metric, nodes are
+        (server, instance) tuples. Positions are the first 16 bits of an md5 and must stay exactly as carbon
+        computes them or metrics would be routed to a different instance than the relay would use.
+    """
+    def __init__(self, nodes, replica_count=REPLICA_COUNT):
+        self.ring = []
+        self.replica_count = replica_count
+        for node in nodes:
+            self.add_node(node)
+
+    def position(self, key):
+        return int(hashlib.md5(key).hexdigest()[:4], 16)
+
+    def add_node(self, node):
+        positions = set(entry[0] for entry in self.ring)
+        for i in range(self.replica_count):
+            position = self.position('%s:%d' % (node, i))
+            while position in positions:
+                position += 1
+            positions.add(position)
+            bisect.insort(self.ring, (position, node))
+
+    def get_node(self, key):
+        index = bisect.bisect_left(self.ring, (self.position(key),)) % len(self.ring)
+        return self.ring[index][1]
+
+
+class CarbonRouter(object):
+    """ Routes metrics to several carbon destinations by consistent hash, each with its own CarbonClient.
+        It can be used in place of a CarbonClient.
+    """
+    def __init__(self, destinations, batch_size=BATCH_SIZE, pickle=False, timeout=CARBON_TIMEOUT):
+        self.batch_size = batch_size
+        self.clients = []
+        self.nodes = {}
+        for server, port, instance in destinations:
+            client = CarbonClient(server, port, batch_size, pickle, timeout)
+            self.clients.append(client)
+            self.nodes[(server, instance)] = client
+        self.ring = ConsistentHashRing([(server, instance) for server, port, instance in destinations])
+        self.routes = {}
+        self.error = None
+
+    def route(self, lines):
+        "Returns a list of (client, lines) grouping the lines by the destination which owns them."
+        groups = {}
+        routes = self.routes
+        for line in lines:
+            path = line.split(' ', 1)[0]
+            client = routes.get(path)
+            if client is None:
+                if len(routes) >= ROUTE_CACHE_SIZE:
+                    routes.clear()
+                client = routes[path] = self.nodes[self.ring.get_node(path)]
+            groups.setdefault(client, []).append(line)
+        return groups.items()
+
+    def connect_once(self):
+        "Try to connect to each destination, returns True if all are connected."
+        connected = True
+        for client in self.clients:
+            if not client.connect_once():
+                self.error = client.error
+                connected = False
+        return connected
+
+    def connect(self):
+        "Connect to every destination, retrying until successful."
+        for client in self.clients:
+            client.connect()
+
+    def send(self, lines, retry=True):
+        """ Send the lines each to its destination.
+            If retry is False the lines are still sent to the destinations which can be reached before the
+            first socket.error is raised.
+        """
+        error = None
+        for client, client_lines in self.route(lines):
+            try:
+                client.send(client_lines, retry)
+            except socket.error, e:
+                error = error or e
+        if error is not None:
+            raise error
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+
+class DiskBuffer(object):
+    """ A durable queue of plaintext protocol lines for when carbon is unreachable.
+        Lines are appended to numbered segment files in directory, the newest segment is the one written to.
+        Writers hold a shared lock while appending and replay takes an exclusive lock only to start a new
+        segment so those it reads are complete. The segment and byte offset sent so far are kept in the
+        index file, rewritten atomically after each batch. Only one replay runs at a time.
+    """
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.index_path = os.path.join(directory, 'index')
+        self.write_lock = os.path.join(directory, 'write.lock')
+        self.replay_lock = os.path.join(directory, 'replay.lock')
+
+    def segments(self):
+        "Returns the sorted segment numbers."
+        return sorted(int(name.split('.', 1)[1]) for name in os.listdir(self.directory)
+            if name.startswith('segment.'))
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, 'segment.%d' % number)
+
+    def append(self, lines):
+        "Append the lines to the newest segment."
+        lock = os.open(self.write_lock, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            segments = self.segments()
+            if segments:
+                number = segments[-1]
+            else:
+                number = self.read_index()[0]
+            fd = os.open(self.segment_path(number), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+            try:
+                os.write(fd, "\n".join(lines) + "\n")
+            finally:
+                os.close(fd)
+        finally:
+            os.close(lock)
+
+    def read_index(self):
+        "Returns a tuple of (segment, offset) sent so far."
+        try:
+            with open(self.index_path, 'r') as index:
+                data = json.load(index)
+            return data['segment'], data['offset']
+        except (IOError, ValueError, KeyError):
+            return 0, 0
+
+    def write_index(self, segment, offset):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as index:
+            json.dump({'segment': segment, 'offset': offset}, index)
+        os.rename(tmp_path, self.index_path)
+
+    def depth(self):
+        "Returns the number of bytes in the buffer which haven't been sent."
+        segment, offset = self.read_index()
+        depth = 0
+        for number in self.segments():
+            size = os.path.getsize(self.segment_path(number))
+            if number == segment:
+                size = max(size - offset, 0)
+            if number >= segment:
+                depth += size
+        return depth
+
+    def pending(self):
+        "True if there is data in the buffer which hasn't been sent."
+        segments = self.segments()
+        if len(segments) > 1:
+            return True
+        if len(segments) == 0:
+            return False
+        segment, offset = self.read_index()
+        size = os.path.getsize(self.segment_path(segments[0]))
+        return size > (offset if segment == segments[0] else 0)
+
+    def seal(self):
+        "Start a new segment if the newest has data so it can be replayed."
+        lock = os.open(self.write_lock, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            segments = self.segments()
+            if segments and os.path.getsize(self.segment_path(segments[-1])) > 0:
+                os.close(os.open(self.segment_path(segments[-1] + 1), os.O_WRONLY | os.O_CREAT, 0644))
+        finally:
+            os.close(lock)
+
+    def replay(self, client, rate, duration=None):
+        """ Send buffered lines to carbon at up to rate metrics per second, for at most duration seconds if
+            given. Returns the number of lines sent, 0 if another replay is running. Raises socket.error if
+            carbon can't be reached.
+        """
+        lock = os.open(self.replay_lock, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return 0
+            start = time.time()
+            sent = 0
+            if len(self.segments()) == 1:
+                self.seal()
+            segment, offset = self.read_index()
+            for number in self.segments()[:-1]:
+                if number < segment: #Already sent
+                    os.remove(self.segment_path(number))
+                    continue
+                if number > segment:
+                    segment, offset = number, 0
+                with open(self.segment_path(number), 'r') as segment_file:
+                    segment_file.seek(offset)
+                    while True:
+                        lines = []
+                        size = 0
+                        for line in iter(segment_file.readline, ''):
+                            size += len(line)
+                            if line.strip():
+                                lines.append(line.rstrip('\n'))
+                            if len(lines) >= client.batch_size:
+                                break
+                        if size == 0:
+                            break
+                        client.send(lines, retry=False)
+                        offset += size
+                        self.write_index(segment, offset)
+                        sent += len(lines)
+                        if rate:
+                            time.sleep(len(lines) / float(rate))
+                        if duration is not None and time.time() - start >= duration:
+                            return sent
+                os.remove(self.segment_path(number))
+                self.write_index(segment + 1, 0)
+                segment, offset = segment + 1, 0
+            return sent
+        finally:
+            os.close(lock)
+
+
+class FileSpool(object):
+    """ Reads lines appended to a spool file by spool_file.
+        The spool is renamed before reading so writers start a new file, the renamed file is removed once
+        its lines have been sent. A renamed file left from a previous run is sent first.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.relaying = path + '.relaying'
+
+    def read(self, timeout):
+        "Returns a list of lines from the spool, waiting up to timeout seconds for some if none are ready."
+        if not os.path.exists(self.relaying):
+            try:
+                os.rename(self.path, self.relaying)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                time.sleep(timeout)
+                return []
+            time.sleep(SPOOL_GRACE)
+        with open(self.relaying, 'r') as spool:
+            return [line.rstrip('\n') for line in spool if line.strip()]
+
+    def sent(self):
+        "Called once the lines from the last read are sent."
+        if os.path.exists(self.relaying):
+            os.remove(self.relaying)
+
+    def close(self):
+        pass
+
+
+class SocketSpool(object):
+    "Reads lines sent to a unix datagram socket by spool_socket."
+    def __init__(self, path, batch_size=BATCH_SIZE):
+        if os.path.exists(path): #Remove a stale socket
+            os.remove(path)
+        self.path = path
+        self.batch_size = batch_size
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+
+    def read(self, timeout):
+        """ Returns a list of lines received, waiting up to timeout seconds for the first datagram then
+            reading until batch_size lines are collected or timeout seconds have passed.
+        """
+        lines = []
+        deadline = time.time() + timeout
+        while len(lines) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self.sock.settimeout(remaining)
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                break
+            lines.extend(line for line in data.split('\n') if line.strip())
+        return lines
+
+    def sent(self):
+        pass
+
+    def close(self):
+        self.sock.close()
+        os.remove(self.path)
+
+
+def relay(options):
+    "Send data from the spool to carbon until interrupted or terminated."
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, interrupt)
+
+    if options.spool_socket is not None:
+        spool = SocketSpool(options.spool_socket, options.batch_size or BATCH_SIZE)
+    else:
+        spool = FileSpool(options.spool)
+    client = carbon_client(options, options.batch_size or BATCH_SIZE)
+    buffer = None
+    if options.buffer is not None:
+        buffer = DiskBuffer(options.buffer)
+    stats_at = time.time() + options.stats_interval
+    try:
+        while True:
+            lines = spool.read(FLUSH_INTERVAL)
+            if lines:
+                stats.lines_parsed += len(lines)
+                deliver(client, buffer, lines)
+            spool.sent()
+            if options.stats_interval and time.time() >= stats_at:
+                stats_at += options.stats_interval
+                send_stats(options, client, buffer)
+            if buffer is not None and buffer.pending() and client.connect_once():
+                try:
+                    buffer.replay(client, options.replay_rate, FLUSH_INTERVAL)
+                except socket.error, e:
+                    print "Error replaying the buffer to carbon, %s" % e
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+        spool.close()
+    return 0
+
+def replay(options):
+    "Replay the buffer to carbon until it is empty."
+    buffer = DiskBuffer(options.buffer)
+    client = carbon_client(options, options.batch_size or BATCH_SIZE)
+    try:
+        while buffer.pending():
+            client.connect()
+            try:
+                if buffer.replay(client, options.replay_rate) == 0 and buffer.pending():
+                    print 'Another replay of %s is running' % options.buffer
+                    return 1
+            except socket.error, e:
+                print "Error replaying the buffer to carbon, %s" % e
+        send_stats(options, client, buffer)
+    finally:
+        client.close()
+    return 0
 
 
 if __name__ == "__main__":
     sys.exit(main())
-
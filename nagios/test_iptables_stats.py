@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+""" Tests for the iptables-stats.py output and thresholds, buildOutput is run on hand built results.
+
+    python test_iptables_stats.py
+"""
+import imp
+import os
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'iptables-stats.py')
+check = imp.load_source('iptables_stats', SCRIPT)
+
+#(line number, packets, bytes, accepted), the byte counts differ from the packet counts so a mix up shows
+RESULTS = ((1, 10, 1000, True), (2, 5, 300, False), (3, 20, 2000, True))
+
+
+def build(*args):
+    "Returns buildOutput's (exit code, message, perfdata) for RESULTS with the given command line options."
+    return check.buildOutput(RESULTS, check.parseArgs(['iptables-stats.py'] + list(args)))
+
+
+class BuildOutputTest(unittest.TestCase):
+    def test_totals(self):
+        exit, mesg, perf = build('-t')
+        self.assertEqual(exit, 0)
+        self.assertEqual(mesg, ' Accepted Packet Total:30 Blocked Packet Total:5'
+                               ' Accepted Bytes Total:3000 Blocked Bytes Total:300')
+        self.assertEqual(perf, " 'Total Packets Accepted'=30;0;0 'Total Packets Blocked'=5;0;0"
+                               " 'Total Bytes Accepted'=3000;0;0 'Total Bytes Blocked'=300;0;0")
+
+    def test_individuals(self):
+        exit, mesg, perf = build('-i')
+        self.assertEqual(exit, 0)
+        self.assertEqual(mesg, ' Rule 1 Accepted Packets:10 Rule 2 Packet Total:5 Rule 3 Accepted Packets:20'
+                               ' Rule 1 Accepted Bytes:1000 Rule 2 Bytes Total:300 Rule 3 Accepted Bytes:2000')
+        self.assertIn(" 'Rule 2 Bytes Blocked'=300;0;0 'Rule 3 Bytes Accepted'=2000;0;0", perf)
+
+    def test_totals_and_individuals(self):
+        exit, mesg, perf = build('-t', '-i', '-b')
+        self.assertEqual(mesg, ' Accepted Bytes Total:3000 Blocked Bytes Total:300'
+                               ' Rule 1 Accepted Bytes:1000 Rule 2 Bytes Total:300 Rule 3 Accepted Bytes:2000')
+
+    def test_packet_only(self):
+        exit, mesg, perf = build('-t', '-i', '-p')
+        self.assertNotIn('Bytes', mesg)
+        self.assertNotIn('Bytes', perf)
+
+    def test_accepted_only(self):
+        exit, mesg, perf = build('-t', '-i', '--accepted-only')
+        self.assertNotIn('Blocked', mesg)
+        self.assertNotIn('Rule 2', mesg)
+        self.assertIn('Accepted Bytes Total:3000', mesg)
+
+    def test_blocked_only(self):
+        exit, mesg, perf = build('-t', '-i', '--blocked-only')
+        self.assertNotIn('Accepted', mesg)
+        self.assertEqual(mesg, ' Blocked Packet Total:5 Rule 2 Packet Total:5 Blocked Bytes Total:300 Rule 2 Bytes Total:300')
+
+    def test_byte_limits_use_bytes(self):
+        #Only the byte counts are over the byte warning, the packet counts are not
+        exit, mesg, perf = build('-t', '--byte-warning', '2500', '--packet-warning', '100')
+        self.assertEqual(exit, 1)
+        self.assertEqual(mesg.count('WARNING!'), 1)
+        self.assertIn(' WARNING!  Accepted Bytes Total:3000', mesg)
+        self.assertIn("'Total Bytes Accepted'=3000;2500;0", perf)
+
+    def test_critical_over_warning(self):
+        exit, mesg, perf = build('-t', '-b', '-w', '500', '-c', '2500')
+        self.assertEqual(exit, 2)
+        self.assertEqual(mesg, ' Critical!  Accepted Bytes Total:3000 Blocked Bytes Total:300')
+
+    def test_warning(self):
+        exit, mesg, perf = build('-t', '-b', '-w', '500', '-c', '5000')
+        self.assertEqual(exit, 1)
+        self.assertEqual(mesg, ' WARNING!  Accepted Bytes Total:3000 Blocked Bytes Total:300')
+
+    def test_warning_after_critical(self):
+        #A later warning doesn't lower the exit code from critical
+        exit, mesg, perf = build('-t', '--accepted-only', '--packet-critical', '25', '--byte-warning', '2500')
+        self.assertEqual(exit, 2)
+        self.assertEqual(mesg, ' Critical!  Accepted Packet Total:30 WARNING!  Accepted Bytes Total:3000')
+
+    def test_critical_after_warning(self):
+        exit, mesg, perf = build('-t', '--accepted-only', '--packet-warning', '25', '--byte-critical', '2500')
+        self.assertEqual(exit, 2)
+        self.assertEqual(mesg, ' WARNING!  Accepted Packet Total:30 Critical!  Accepted Bytes Total:3000')
+
+    def test_individual_limits(self):
+        exit, mesg, perf = build('-i', '-b', '-w', '1500')
+        self.assertEqual(exit, 1)
+        self.assertEqual(mesg, ' Rule 1 Accepted Bytes:1000 Rule 2 Bytes Total:300 WARNING!  Rule 3 Accepted Bytes:2000')
+
+    def test_prefix(self):
+        exit, mesg, perf = check.buildOutput(RESULTS, check.parseArgs(['iptables-stats.py', '-t', '-p']), 'filter/INPUT ')
+        self.assertEqual(mesg, ' filter/INPUT Accepted Packet Total:30 filter/INPUT Blocked Packet Total:5')
+        self.assertIn(" 'filter/INPUT Total Packets Accepted'=30;0;0", perf)
+
+
+if __name__ == '__main__':
+    unittest.main()